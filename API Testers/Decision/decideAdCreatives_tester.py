@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
 import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
 
 # Insert PLATFORM NAME, PLATFORM ID, and Event API key shared by your MOLOCO representative.
 PLATFORM_NAME = ''
@@ -43,13 +46,14 @@ HEADERS = {
 
 
 def main():
-    response = requests.post(URL, json=PAYLOAD, headers=HEADERS)
+    response = http_client.post(URL, json=PAYLOAD, headers=HEADERS)
     print("Response headers:")
     print(json.dumps(dict(response.headers), indent=4))
 
     print("\nResponse body:")
     responded_items = json.loads(response.text)
     print(json.dumps(dict(responded_items), indent=4))
+    http_client.PrintConnectionStats()
 
     return(response)
 
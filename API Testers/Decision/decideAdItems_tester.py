@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
 import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
 
 # Insert PLATFORM NAME, PLATFORM ID, and Event API key shared by your MOLOCO representative.
 PLATFORM_NAME = ''
@@ -55,7 +58,7 @@ HEADERS = {
 
 
 def main():
-    response = requests.post(URL, json=PAYLOAD, headers=HEADERS)
+    response = http_client.post(URL, json=PAYLOAD, headers=HEADERS)
     print("Response headers:")
     print(json.dumps(dict(response.headers), indent=4))
 
@@ -69,6 +72,7 @@ def main():
     
     print("\nTotal", len(list_of_items), "items returned")
     print("Item IDs are:", list_of_items)
+    http_client.PrintConnectionStats()
 
     return(response)
 
@@ -0,0 +1,190 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+from event_tester import URL, HEADERS # Set PLATFORM NAME, PLATFORM ID and API key in event_tester.py
+
+# Provide the file of events to send, e.g. to backfill or replay user events.
+# A .jsonl file holds one event payload per line. A .csv file holds one event per row: nested fields use dotted
+# column names (e.g. device.os), and JSON values such as the items list are parsed. Empty cells are left out.
+INPUT_PATH = "events.jsonl"
+
+# The result of every event is written here, e.g. to find and resend the failed events
+STATUS_PATH = "event_status.csv"
+STATUS_COLUMNS = ['line_num', 'id', 'event_type', 'status_code', 'latency_ms', 'error']
+
+# Number of events sent at the same time over the pooled connections, and the limit of events per second.
+# Set EVENTS_PER_SECOND = 0 to send as fast as the workers can.
+WORKERS = 64
+EVENTS_PER_SECOND = 2000
+
+# Events are sent with aiohttp when it is installed (pip install aiohttp): a single thread keeps WORKERS events in
+# flight over its pooled connections, with a fraction of the client CPU time per event of a thread per event.
+# Without it, WORKERS threads send the events with requests through http_client.
+ASYNC_CLIENT = importlib.util.find_spec('aiohttp') is not None
+
+
+# Read the events of a .jsonl or .csv file one by one, with their line number.
+# A line that cannot be parsed is returned as None with its error, so the rest of the file is still sent.
+def ReadEvents(path):
+    with open(path, 'r', newline='') as f:
+        if not path.endswith(".csv"):
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield line_num, json.loads(line), ""
+                    except ValueError as e:
+                        yield line_num, None, "invalid JSON: {0}".format(e)
+            return
+        for line_num, row in enumerate(csv.DictReader(f), 2):
+            try:
+                yield line_num, ParseCsvEvent(row), ""
+            except ValueError as e:
+                yield line_num, None, "invalid JSON: {0}".format(e)
+
+def ParseCsvEvent(row):
+    event = {}
+    for column, value in row.items():
+        if value is None or value == "":
+            continue
+        if value[:1] in "[{":
+            value = json.loads(value)
+        target = event
+        keys = column.split(".")
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return event
+
+def NewStatus(line_num, event, error=""):
+    return {"line_num": line_num, "id": event.get("id", ""), "event_type": event.get("event_type", ""),
+            "status_code": "", "latency_ms": "", "error": error}
+
+# Send a single event and get its status
+def SendEvent(line_num, event):
+    status = NewStatus(line_num, event)
+    start = time.perf_counter()
+    try:
+        response = http_client.post(URL, json=event, headers=HEADERS)
+        status['status_code'] = response.status_code
+        if response.status_code >= 300:
+            status['error'] = response.text
+    except Exception as e:
+        status['error'] = repr(e)
+    status['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return status
+
+# Send a single event over the aiohttp session and get its status
+async def SendEventAsync(session, line_num, event):
+    status = NewStatus(line_num, event)
+    start = time.perf_counter()
+    try:
+        async with session.post(URL, json=event, headers=HEADERS) as response:
+            status['status_code'] = response.status
+            if response.status >= 300:
+                status['error'] = await response.text()
+            else:
+                await response.read()
+    except Exception as e:
+        status['error'] = repr(e)
+    status['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return status
+
+# Writes the status of every event as it is done, and counts the sent and failed events
+class StatusWriter:
+    def __init__(self, statusfile):
+        self.write = csv.DictWriter(statusfile, fieldnames=STATUS_COLUMNS)
+        self.write.writeheader()
+        self.sent = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+
+    def Record(self, status):
+        self.write.writerow(status)
+        self.sent += 1
+        self.failed += status['error'] != ""
+        if self.sent % 10000 == 0:
+            print("{0} events sent, {1} failed, {2:.0f} events/s".format(self.sent, self.failed, self.sent / (time.perf_counter() - self.start)))
+
+# Send the events with WORKERS threads. At most a few batches of events are read ahead of the sending workers.
+def SendEventsThreaded(events, statuses):
+    http_client.SetConcurrency(WORKERS)
+    http_client.SetRequestsPerSecond(EVENTS_PER_SECOND)
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        pending = set()
+        while True:
+            for line_num, event, error in events:
+                if event is None:
+                    statuses.Record(NewStatus(line_num, {}, error))
+                    continue
+                pending.add(executor.submit(SendEvent, line_num, event))
+                if len(pending) >= WORKERS * 4:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                statuses.Record(future.result())
+
+# Send the events with aiohttp, WORKERS at the same time. Events are read only as fast as they are sent.
+async def SendEventsAsync(events, statuses):
+    import aiohttp
+    rate_limiter = http_client.RateLimiter(EVENTS_PER_SECOND) if EVENTS_PER_SECOND else None
+    connector = aiohttp.TCPConnector(limit=WORKERS)
+    timeout = aiohttp.ClientTimeout(sock_connect=http_client.TIMEOUT[0], sock_read=http_client.TIMEOUT[1])
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=http_client.HEADERS) as session:
+        pending = set()
+        for line_num, event, error in events:
+            if event is None:
+                statuses.Record(NewStatus(line_num, {}, error))
+                continue
+            if len(pending) >= WORKERS:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    statuses.Record(task.result())
+            if rate_limiter is not None:
+                await asyncio.sleep(rate_limiter.Delay())
+            pending.add(asyncio.create_task(SendEventAsync(session, line_num, event)))
+        for status in await asyncio.gather(*pending):
+            statuses.Record(status)
+
+# Send all the events of the file, with aiohttp if ASYNC_CLIENT is set, or else with threads
+def BulkSendEvents(input_path=INPUT_PATH, status_path=STATUS_PATH):
+    with open(status_path, 'w', newline='') as statusfile:
+        statuses = StatusWriter(statusfile)
+        if ASYNC_CLIENT:
+            asyncio.run(SendEventsAsync(ReadEvents(input_path), statuses))
+        else:
+            SendEventsThreaded(ReadEvents(input_path), statuses)
+    seconds = time.perf_counter() - statuses.start
+    return("Total {0} events are sent in {1:.1f} seconds ({2:.0f} events/s), {3} failed. Statuses are written to {4}.".format(
+        statuses.sent, seconds, statuses.sent / seconds if seconds else 0, statuses.failed, status_path))
+
+
+def main():
+    print(BulkSendEvents())
+    http_client.PrintConnectionStats()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Load generator of the event API.
+# Simulated users browse in sessions: every session walks from HOME through SEARCH, ITEM_PAGE_VIEW and ADD_TO_CART
+# to PURCHASE, or leaves on the way. Every event has a new id and timestamp, and items are drawn from a catalog file.
+# The rate of events rises from START_QPS to TARGET_QPS and is then held, and the throughput and latencies are reported.
+
+import csv
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import shortuuid
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+from event_tester import URL, HEADERS, NewEvent, HOME, SEARCH, ITEM_PAGE_VIEW, ADD_TO_CART, PURCHASE
+
+# Number of simulated users, and the rate of events: from START_QPS to TARGET_QPS in RAMP_SECONDS, then held for HOLD_SECONDS
+USERS = 1000
+START_QPS = 10
+TARGET_QPS = 200
+RAMP_SECONDS = 30
+HOLD_SECONDS = 60
+
+# Number of events sent at the same time. Keep it above TARGET_QPS times the expected latency in seconds.
+WORKERS = 64
+
+# Item ids and prices are drawn from the first MAX_ITEMS items of the catalog. Without the file, made-up items are used.
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Catalog Tester", "item_catalog.tsv")
+MAX_ITEMS = 100000
+SEARCH_QUERIES = ["MEN", "WOMEN", "SHOES", "BAG", "SALE", "NEW"]
+
+# Set LOCAL_SERVER = True to send to a stand-in endpoint on this machine instead of URL, e.g. to test the load generator
+# or the event pipeline without the API. It answers every event after LOCAL_LATENCY_MS.
+LOCAL_SERVER = False
+LOCAL_LATENCY_MS = 5
+
+# Next event of the session after each event, with its probability. None ends the session.
+TRANSITIONS = {
+    None: [("HOME", 1.0)],
+    "HOME": [("SEARCH", 0.7), ("ITEM_PAGE_VIEW", 0.2), (None, 0.1)],
+    "SEARCH": [("ITEM_PAGE_VIEW", 0.7), ("SEARCH", 0.2), (None, 0.1)],
+    "ITEM_PAGE_VIEW": [("ADD_TO_CART", 0.3), ("ITEM_PAGE_VIEW", 0.3), ("SEARCH", 0.2), (None, 0.2)],
+    "ADD_TO_CART": [("PURCHASE", 0.5), ("ITEM_PAGE_VIEW", 0.3), (None, 0.2)],
+    "PURCHASE": [("HOME", 0.3), (None, 0.7)]
+}
+
+
+def IsPrice(value):
+    try:
+        return float(value) >= 0
+    except (TypeError, ValueError):
+        return False
+
+# Get (id, price) of the catalog items, skipping items without an id or a valid price
+def LoadItems(path=CATALOG_PATH, max_items=MAX_ITEMS):
+    items = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf8', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                price = row.get('price_pc') or row.get('normal_price')
+                if row.get('id') and IsPrice(price):
+                    items.append((row['id'], price))
+                if len(items) >= max_items:
+                    break
+    if not items:
+        items = [("ITEM{0:06d}".format(i), str(random.randrange(1000, 100000, 100))) for i in range(max_items)]
+    return items
+
+# One simulated user, and the state of its current session
+class UserSession:
+    def __init__(self, items):
+        self.items = items
+        self.user_id = "USER_" + shortuuid.ShortUUID().random(length=12)
+        self.state = None
+        self.item = None
+        self.cart = []
+
+    def NextEvent(self):
+        events, weights = zip(*TRANSITIONS[self.state])
+        self.state = random.choices(events, weights)[0]
+        if self.state is None:
+            self.state = "HOME"
+        if self.state == "HOME":
+            # A new session starts
+            self.session_id = "SESSION_" + shortuuid.ShortUUID().random(length=12)
+            self.cart = []
+        fields = {"user_id": self.user_id, "session_id": self.session_id}
+
+        if self.state == "HOME":
+            return NewEvent(HOME, **fields)
+        if self.state == "SEARCH":
+            return NewEvent(SEARCH, search_query=random.choice(SEARCH_QUERIES), **fields)
+        if self.state == "ITEM_PAGE_VIEW":
+            self.item = random.choice(self.items)
+            return NewEvent(ITEM_PAGE_VIEW, page_id="app/product/" + self.item[0],
+                            items=[{"id": self.item[0], "price": self.item[1], "quantity": 1}], **fields)
+        if self.state == "ADD_TO_CART":
+            self.cart.append(self.item)
+            return NewEvent(ADD_TO_CART, page_id="app/product/" + self.item[0],
+                            items=[{"id": self.item[0], "price": self.item[1], "quantity": 1}], **fields)
+        # PURCHASE of the items in the cart
+        cart, self.cart = self.cart, []
+        amount = sum(float(price) for _, price in cart)
+        return NewEvent(PURCHASE, items=[{"id": item_id, "price": price, "quantity": 1} for item_id, price in cart],
+                        revenue={"currency": PURCHASE["revenue"]["currency"], "amount": str(int(amount)) if amount.is_integer() else str(amount)},
+                        **fields)
+
+# Number of events due after `elapsed` seconds, the integral of the linearly rising and then constant rate
+def EventsDue(elapsed):
+    ramp = min(elapsed, RAMP_SECONDS)
+    due = START_QPS * ramp + (TARGET_QPS - START_QPS) * ramp * ramp / (2 * RAMP_SECONDS) if RAMP_SECONDS else 0
+    return int(due + TARGET_QPS * max(elapsed - RAMP_SECONDS, 0))
+
+def SendEvent(url, event):
+    start = time.perf_counter()
+    try:
+        status = http_client.post(url, json=event, headers=HEADERS).status_code
+    except Exception as e:
+        status = type(e).__name__
+    return event["event_type"], status, time.perf_counter() - start, start
+
+# Stand-in event endpoint on localhost, answering every event after latency_ms
+def StartLocalServer(latency_ms=LOCAL_LATENCY_MS):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            time.sleep(latency_ms / 1000)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{0}/userevents".format(server.server_port)
+
+def Percentile(values, percent):
+    return values[min(int(len(values) * percent / 100), len(values) - 1)] if values else 0
+
+def PrintLoadReport(results, seconds):
+    latencies = sorted(latency * 1000 for _, _, latency, _ in results)
+    hold = [result for result in results if result[3] >= RAMP_SECONDS]
+    print("Total {0} events in {1:.1f} seconds, {2:.1f} events/s".format(len(results), seconds, len(results) / seconds if seconds else 0))
+    if HOLD_SECONDS:
+        print("At TARGET_QPS {0}: {1:.1f} events/s".format(TARGET_QPS, len(hold) / HOLD_SECONDS))
+    print("Latency ms: p50 {0:.1f}, p90 {1:.1f}, p99 {2:.1f}, max {3:.1f}".format(
+        Percentile(latencies, 50), Percentile(latencies, 90), Percentile(latencies, 99), latencies[-1] if latencies else 0))
+    print("Events:", dict(Counter(event_type for event_type, _, _, _ in results)))
+    print("Statuses:", dict(Counter(status for _, status, _, _ in results)))
+
+# Send the events of the simulated users at the rising and then constant rate, and get (event_type, status, latency, sent_at)
+def RunLoad(url):
+    http_client.SetConcurrency(WORKERS)
+    items = LoadItems()
+    users = [UserSession(items) for _ in range(USERS)]
+    results = []
+    pending = set()
+    sent = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= RAMP_SECONDS + HOLD_SECONDS:
+                break
+            # Events that cannot be sent because all the workers are busy are dropped, so the rate is not bursted later
+            due = EventsDue(elapsed)
+            while sent < due:
+                if len(pending) < WORKERS * 2:
+                    future = executor.submit(SendEvent, url, random.choice(users).NextEvent())
+                    pending.add(future)
+                sent += 1
+            if not pending:
+                time.sleep(0.001)
+                continue
+            done, pending = wait(pending, timeout=0.005, return_when=FIRST_COMPLETED)
+            results += [future.result() for future in done]
+        results += [future.result() for future in wait(pending).done]
+    seconds = time.perf_counter() - start
+    # Times relative to the start, to split the ramp from the hold
+    return [(event_type, status, latency, sent_at - start) for event_type, status, latency, sent_at in results], seconds, sent - len(results)
+
+
+def main():
+    url = StartLocalServer() if LOCAL_SERVER else URL
+    results, seconds, dropped = RunLoad(url)
+    PrintLoadReport(results, seconds)
+    if dropped:
+        print("{0} events were not sent because all the workers were busy, raise WORKERS".format(dropped))
+    http_client.PrintConnectionStats()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import time
-import requests
 import shortuuid
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
 
 # Insert PLATFORM NAME, PLATFORM ID, and Event API key shared by your MOLOCO representative.
 PLATFORM_NAME = ''
@@ -134,11 +138,21 @@ ADD_TO_WISHLIST = (PAYLOAD |{
     ]
 })
 
+# The events above are built once, when this file is loaded. Copy one of them with a new id and the current timestamp
+# before sending it, and override its other fields with keyword arguments, e.g. NewEvent(SEARCH, search_query="SHOES").
+def NewEvent(template, **fields):
+    event = copy.deepcopy(template)
+    event["id"] = str(shortuuid.ShortUUID().random(length=8))
+    event["timestamp"] = str(round(time.time()*1000))
+    event.update(fields)
+    return event
+
 
 def main():
-    request_payload = HOME # Replace the value with one of the event types above.
+    request_payload = NewEvent(HOME) # Replace the value with one of the event types above.
     print(request_payload)
-    response = requests.post(URL, json=request_payload, headers=HEADERS)
+    response = http_client.post(URL, json=request_payload, headers=HEADERS)
+    http_client.PrintConnectionStats()
     return(response)
 
 if __name__ == '__main__':
@@ -14,7 +14,14 @@
 
 import csv
 import json
-import requests
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+from token_provider import TokenProvider
+from checkpoint_journal import CheckpointJournal, RaiseForRetryableStatus, RetryWithBackoff
+from list_items_in_campaigns import IterAdAccounts, IterCampaigns, IterPages, ListAdAccount
 
 PLATFORM_NAME = "" # Platform name. e.g. MOLOCO
 PLATFORM_ID = "" # Platform ID e.g. MOLOCO_TEST
@@ -30,28 +37,24 @@ FILE_PATH = ""
 EMAIL = ""
 PWD = ""
 
+# Number of rows created at the same time, and the limit of API calls per second summed over all of them.
+# Ad accounts are always created before any campaign of the account.
+WORKERS = 8
+REQUESTS_PER_SECOND = 10
+
+# The result of every row is written here, e.g. to find and retry the failed rows
+RESULT_FILE_PATH = "bulk_create_result.csv"
+RESULT_COLUMNS = ['row_num', 'ad_account_id', 'campaign_title', 'ad_account_result', 'campaign_result', 'campaign_id', 'error']
+
+# Every finished row is appended to the journal. Set RESUME = True, or run the script with --resume,
+# to continue an interrupted run: rows whose campaign was already created are skipped.
+JOURNAL_FILE_PATH = "bulk_create_journal.jsonl"
+RESUME = False
+
 
 def ParseFile():
     return csv.DictReader(open(FILE_PATH, 'r'), delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL, skipinitialspace=True)
 
-# Get token based on the credential
-def CreateToken(base_url, email, pw):
-    url = base_url + "/tokens"
-    payload = {
-        "auth_type": "CREDENTIAL",
-        "credential_type_payload": {
-            "email": email,
-            "password": pw
-        }
-    }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json"
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    json_formatted = json.loads(response.text)
-    return (json_formatted['token'])
-
 # Create ad account based on the data provided at the file
 def CreateAdAccount(base_url, ad_account_id, ad_account_title, token):
     url = base_url + "/ad-accounts"
@@ -69,10 +72,9 @@ def CreateAdAccount(base_url, ad_account_id, ad_account_title, token):
     }
     headers = {
         "accept": "application/json",
-        "content-type": "application/json",
-        "Authorization": "Bearer " + token
+        "content-type": "application/json"
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = RaiseForRetryableStatus(http_client.post(url, json=payload, headers=headers, auth=token))
     json_formatted = json.loads(response.text)
     return (json_formatted)
 
@@ -108,43 +110,158 @@ def CreateCampaign(base_url, ad_account_id, campaign_title, goal_setting, daily_
     }
     headers = {
         "accept": "application/json",
-        "content-type": "application/json",
-        "Authorization": "Bearer " + token
+        "content-type": "application/json"
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = RaiseForRetryableStatus(http_client.post(url, json=payload, headers=headers, auth=token))
     json_formatted = json.loads(response.text)
-    print(json.dumps(json_formatted, indent=4))
     return (json_formatted)
 
-# Create campaigns based on the data provided at the file
-def BulkCreateCampaignsFromFile(token):
-    for row_num, data in enumerate(ParseFile()):
-        ad_account_id = data['ad_account_id'].replace('"', '').strip()
-        ad_account_title = data['ad_account_title'].replace('"', '').strip()
-        campaign_title = data['campaign_title'].replace('"', '').strip()
-        goal_setting = data['goal_setting'].replace('"', '').strip()
-        daily_budget = data['daily_budget_max'].replace('"', '').strip()
-        schedule_start = data['campaign_schedule_start'].replace('"', '').strip()
-        schedule_end = data['campaign_schedule_end'].replace('"', '').strip()
-        items = [item.replace('[', '').replace(']', '').replace(',', '') for item in data['items'].replace('"', '').strip().split()]
-        enabling_state = data['enabling_state'].replace('"', '').strip()
-
-        print("*********************************************")
-        print("creating data {0}: {1}".format(row_num, data))
-        print("ad account: id {id} / title {title}".format(id=ad_account_id, title=ad_account_title))
-        print(CreateAdAccount(BASE_URL, ad_account_id, ad_account_title, token))
-
-        print("campaign: title {title}".format(title=campaign_title))
-        print(CreateCampaign(BASE_URL, ad_account_id, campaign_title, goal_setting,
-                       daily_budget, schedule_start, schedule_end, items, enabling_state, token))
-        print("*********************************************")
-    return("Total {0} items are created.".format(row_num+1))
+# Read campaign settings of a row in the file
+def ParseRow(row_num, data):
+    return {
+        "row_num": row_num,
+        "ad_account_id": data['ad_account_id'].replace('"', '').strip(),
+        "ad_account_title": data['ad_account_title'].replace('"', '').strip(),
+        "campaign_title": data['campaign_title'].replace('"', '').strip(),
+        "goal_setting": data['goal_setting'].replace('"', '').strip(),
+        "daily_budget": data['daily_budget_max'].replace('"', '').strip(),
+        "schedule_start": data['campaign_schedule_start'].replace('"', '').strip(),
+        "schedule_end": data['campaign_schedule_end'].replace('"', '').strip(),
+        "items": [item.replace('[', '').replace(']', '').replace(',', '') for item in data['items'].replace('"', '').strip().split()],
+        "enabling_state": data['enabling_state'].replace('"', '').strip()
+    }
+
+# Find an ad account of the platform by its id, or None
+def FindAdAccount(base_url, ad_account_id, token):
+    return next((ad_account for ad_account in IterAdAccounts(base_url, token) if ad_account.get('id') == ad_account_id), None)
+
+# Create the ad account of a row, retrying failed calls. Like CreateRowCampaignOnce, a create that failed
+# may still have created the ad account, so before it is sent again the ad account is looked up by its id.
+def CreateRowAdAccountOnce(row, token):
+    sent = []
+    def CreateAdAccountAttempt():
+        if sent:
+            ad_account = FindAdAccount(BASE_URL, row['ad_account_id'], token)
+            if ad_account is not None:
+                return {"ad_account": ad_account}
+        sent.append(True)
+        return CreateAdAccount(BASE_URL, row['ad_account_id'], row['ad_account_title'], token)
+    return RetryWithBackoff(CreateAdAccountAttempt)
+
+# Create the ad account of a row
+def CreateRowAdAccount(row, token):
+    try:
+        response = CreateRowAdAccountOnce(row, token)
+    except Exception as e:
+        response = {"error": repr(e)}
+    return "created" if "ad_account" in response else "not created"
+
+# Find a campaign of the ad account by its title, or None
+def FindCampaign(base_url, ad_account_id, campaign_title, token):
+    return next((campaign for campaign in IterCampaigns(base_url, ad_account_id, token) if campaign.get('title') == campaign_title), None)
+
+# Create the campaign of a row, retrying failed calls. A create that timed out, lost its connection or got a 5xx
+# may still have created the campaign, so before it is sent again the campaign is looked up by its title.
+def CreateRowCampaignOnce(row, token):
+    sent = []
+    def CreateCampaignAttempt():
+        if sent:
+            campaign = FindCampaign(BASE_URL, row['ad_account_id'], row['campaign_title'], token)
+            if campaign is not None:
+                return {"campaign": campaign}
+        sent.append(True)
+        return CreateCampaign(BASE_URL, row['ad_account_id'], row['campaign_title'], row['goal_setting'], row['daily_budget'],
+                              row['schedule_start'], row['schedule_end'], row['items'], row['enabling_state'], token)
+    return RetryWithBackoff(CreateCampaignAttempt)
+
+# Ad accounts that already exist are not created again
+def ExistingAdAccount():
+    future = Future()
+    future.set_result("exists")
+    return future
+
+# Create the campaign of a row once its ad account is created, unless an earlier run in the journal created it
+def CreateRowCampaign(row, ad_account_future, token, journal):
+    key = (row['ad_account_id'], row['campaign_title'])
+    result = journal.Done(row['row_num'], key)
+    if result is not None:
+        return dict(result, campaign_result="already created")
+
+    result = {
+        "row_num": row['row_num'],
+        "ad_account_id": row['ad_account_id'],
+        "campaign_title": row['campaign_title'],
+        "ad_account_result": ad_account_future.result(),
+        "campaign_result": "not created",
+        "campaign_id": "",
+        "error": ""
+    }
+    try:
+        campaign = CreateRowCampaignOnce(row, token)
+    except Exception as e:
+        campaign = {"error": repr(e)}
+    if "campaign" in campaign:
+        result['campaign_result'] = "created"
+        result['campaign_id'] = campaign['campaign'].get('id', "")
+    else:
+        result['error'] = json.dumps(campaign)
+    journal.Record(row['row_num'], key, result['campaign_result'] == "created", result)
+    return result
+
+# Create campaigns based on the data provided at the file.
+# Existing ad accounts are listed once (every page of them), and every missing ad account is created once, by the first row of the account.
+# Every ad account is submitted before any campaign, so a campaign only waits for an ad account that is already being created.
+def BulkCreateCampaignsFromFile(token, resume=RESUME):
+    rows = [ParseRow(row_num, data) for row_num, data in enumerate(ParseFile())]
+    http_client.SetRequestsPerSecond(REQUESTS_PER_SECOND)
+    list_calls = []
+    def ListAdAccountPage(page_token):
+        list_calls.append(page_token)
+        return ListAdAccount(BASE_URL, token, page_token)
+    known_ad_account_ids = {ad_account['id'] for ad_account in IterPages(ListAdAccountPage, "ad_accounts")}
+
+    results = []
+    with CheckpointJournal(JOURNAL_FILE_PATH, resume) as journal, ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        ad_account_futures = {}
+        for row in rows:
+            if row['ad_account_id'] in ad_account_futures:
+                continue
+            if row['ad_account_id'] in known_ad_account_ids:
+                ad_account_futures[row['ad_account_id']] = ExistingAdAccount()
+            else:
+                ad_account_futures[row['ad_account_id']] = executor.submit(CreateRowAdAccount, row, token)
+        campaign_futures = [executor.submit(CreateRowCampaign, row, ad_account_futures[row['ad_account_id']], token, journal) for row in rows]
+
+        for future in as_completed(campaign_futures):
+            result = future.result()
+            results.append(result)
+            print("row {0} ({1}/{2}): ad account {3} {4}, campaign {5} {6} {7}".format(
+                result['row_num'], len(results), len(rows), result['ad_account_id'], result['ad_account_result'],
+                result['campaign_title'], result['campaign_result'], result['error']))
+
+    with open(RESULT_FILE_PATH, 'w', newline='') as csvfile:
+        write = csv.DictWriter(csvfile, fieldnames=RESULT_COLUMNS)
+        write.writeheader()
+        write.writerows(sorted(results, key=lambda result: result['row_num']))
+
+    # One list call per page of ad accounts plus one call per missing ad account, instead of one create call per row
+    ad_account_results = [future.result() for future in ad_account_futures.values()]
+    ad_account_calls = len(list_calls) + len(ad_account_results) - ad_account_results.count("exists")
+    print("Ad accounts: {0} existed, {1} created, {2} not created. {3} ad account calls made instead of {4}, {5} calls saved.".format(
+        ad_account_results.count("exists"), ad_account_results.count("created"), ad_account_results.count("not created"),
+        ad_account_calls, len(rows), len(rows) - ad_account_calls))
+
+    created = sum(result['campaign_result'] == "created" for result in results)
+    resumed = sum(result['campaign_result'] == "already created" for result in results)
+    return("Total {0} of {1} campaigns are created, {2} were created by an earlier run. Results are written to {3}.".format(
+        created, len(rows), resumed, RESULT_FILE_PATH))
 
 
 def main():
-    token = CreateToken(BASE_URL, EMAIL, PWD)
-    response = BulkCreateCampaignsFromFile(token)
+    token = TokenProvider(BASE_URL, EMAIL, PWD)
+    response = BulkCreateCampaignsFromFile(token, RESUME or "--resume" in sys.argv[1:])
     print(response)
+    http_client.PrintConnectionStats()
 
 
 if __name__ == '__main__':
@@ -14,7 +14,14 @@
 
 import csv
 import json
-import requests
+from datetime import datetime
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+from token_provider import TokenProvider
+from checkpoint_journal import CheckpointJournal, RaiseForRetryableStatus, RetryWithBackoff
+from list_items_in_campaigns import IterCampaigns
 
 PLATFORM_NAME = "" # Platform name. e.g. MOLOCO
 PLATFORM_ID = "" # Platform ID e.g. MOLOCO_TEST
@@ -30,54 +37,112 @@ FILE_PATH = ""
 EMAIL = ""
 PWD = ""
 
+# Every finished row is appended to the journal. Set RESUME = True, or run the script with --resume,
+# to continue an interrupted run: rows that were already updated (or up to date) are skipped.
+JOURNAL_FILE_PATH = "bulk_update_journal.jsonl"
+RESUME = False
+
 
 def ParseFile():
     return csv.DictReader(open(FILE_PATH, 'r'), delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL, skipinitialspace=True)
 
-# Get token based on the credential
-def CreateToken(base_url, email, pw):
-    url = base_url + "/tokens"
-    payload = {
-        "auth_type": "CREDENTIAL",
-        "credential_type_payload": {
-            "email": email,
-            "password": pw
-        }
-    }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json"
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    json_formatted = json.loads(response.text)
-    return (json_formatted['token'])
-
 # Read current campaign data
 def ReadCampaign(base_url, ad_account_id, campaign_id, token):
     url = base_url + "/ad-accounts/" + ad_account_id + "/campaigns/" + campaign_id
     headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + token
+        "accept": "application/json"
     }
-    response = requests.get(url, headers=headers)
+    response = RaiseForRetryableStatus(http_client.get(url, headers=headers, auth=token))
     return (response.text)
 
+# Index the campaigns of an ad account by campaign id, over every page of the campaign list
+def IndexCampaigns(base_url, ad_account_id, token):
+    return {campaign['id']: campaign for campaign in IterCampaigns(base_url, ad_account_id, token)}
+
+# Rows of the file grouped by ad account, in the order the ad accounts first appear
+def RowsByAdAccount():
+    groups = {}
+    for row_num, data in enumerate(ParseFile()):
+        groups.setdefault(data['ad_account_id'].replace('"', '').strip(), []).append((row_num, data))
+    return [row for rows in groups.values() for row in rows]
+
 # Update single campaign
 def UpdateCampaign(base_url, ad_account_id, campaign_id, payload, token):
     url = base_url + "/ad-accounts/" + ad_account_id + "/campaigns/" + campaign_id
     headers = {
         "accept": "application/json",
-        "content-type": "application/json",
-        "Authorization": "Bearer " + token
+        "content-type": "application/json"
     }
     campaign_payload = payload
-    response = requests.put(url, json=campaign_payload, headers=headers)
+    response = RaiseForRetryableStatus(http_client.put(url, json=campaign_payload, headers=headers, auth=token))
     json_formatted = json.loads(response.text)
     return (json_formatted)
 
-# Update campaigns based on the data provided at the file
-def BulkUpdateCampaignsFromFile(token):
-    for row_num, data in enumerate(ParseFile()):
+# Campaign fields set from the file, as paths in the campaign payload
+def TargetFields(campaign_title, schedule_start, schedule_end, daily_budget, goal_setting, items, enabling_state):
+    return {
+        ('title',): campaign_title,
+        ('schedule', 'start'): schedule_start,
+        ('schedule', 'end'): schedule_end,
+        ('daily_budget', 'currency'): CURRENCY,
+        ('daily_budget', 'amount_micro'): daily_budget,
+        ('goal', 'optimize_fixed_cpc', 'target_cpc', 'currency'): CURRENCY,
+        ('goal', 'optimize_fixed_cpc', 'target_cpc', 'amount_micro'): goal_setting,
+        ('catalog_item_ids',): items,
+        ('enabling_state',): enabling_state
+    }
+
+def GetField(campaign, path):
+    for key in path:
+        if not isinstance(campaign, dict):
+            return None
+        campaign = campaign.get(key)
+    return campaign
+
+def SetField(campaign, path, value):
+    for key in path[:-1]:
+        campaign = campaign.setdefault(key, {})
+    campaign[path[-1]] = value
+
+# Item ids are compared as a set, schedules as points in time (the API may return another UTC offset),
+# and amounts as strings, as the API returns int64 values as strings.
+def SameValue(path, current, target):
+    if path == ('catalog_item_ids',):
+        return set(current or []) == set(target)
+    if path[0] == 'schedule':
+        try:
+            return datetime.fromisoformat(current) == datetime.fromisoformat(target)
+        except (TypeError, ValueError):
+            return current == target
+    return current is not None and str(current) == str(target)
+
+# Get the fields of the campaign that differ from the file, with their current and target values
+def CampaignDiff(campaign, target_fields):
+    return {path: (GetField(campaign, path), target)
+            for path, target in target_fields.items() if not SameValue(path, GetField(campaign, path), target)}
+
+def PrintDiff(diff):
+    for path, (current, target) in diff.items():
+        if path == ('catalog_item_ids',):
+            added = set(target) - set(current or [])
+            removed = set(current or []) - set(target)
+            print("  catalog_item_ids: {0} added {1}, {2} removed {3}".format(len(added), sorted(added), len(removed), sorted(removed)))
+        else:
+            print("  {0}: {1} -> {2}".format('.'.join(path), current, target))
+
+# Update campaigns based on the data provided at the file.
+# Campaigns whose settings already match the file are not updated.
+# The campaigns of each ad account are listed once and looked up by campaign id, instead of reading every campaign.
+def BulkUpdateCampaignsFromFile(token, resume=RESUME):
+    rows = RowsByAdAccount()
+    updated = 0
+    resumed = 0
+    failed = 0
+    listed_ad_accounts = 0
+    read_calls = 0
+    indexed_ad_account_id = None
+    journal = CheckpointJournal(JOURNAL_FILE_PATH, resume)
+    for row_num, data in rows:
         # Reads campaign settings from the file
         ad_account_id = data['ad_account_id'].replace('"', '').strip()
         campaign_id = data['campaign_id'].replace('"', '').strip()
@@ -89,32 +154,68 @@ def BulkUpdateCampaignsFromFile(token):
         items = [item.replace('[', '').replace(']', '').replace(',', '') for item in data['items'].replace('"', '').strip().split()]
         enabling_state = data['enabling_state'].replace('"', '').strip()
 
-        # Reads current campaign info based on the campaign_id given from the file
-        loaded_payload = json.loads(ReadCampaign(BASE_URL, ad_account_id, campaign_id, token))
-        
-        # Overwrites campaign settings 
-        loaded_payload['campaign']['title'] = campaign_title
-        loaded_payload['campaign']['schedule']['start'] = schedule_start
-        loaded_payload['campaign']['schedule']['end'] = schedule_end
-        loaded_payload['campaign']['daily_budget']['currency'] = CURRENCY
-        loaded_payload['campaign']['daily_budget']['amount_micro'] = daily_budget
-        loaded_payload['campaign']['goal']['optimize_fixed_cpc']['target_cpc']['currency'] = CURRENCY
-        loaded_payload['campaign']['goal']['optimize_fixed_cpc']['target_cpc']['amount_micro'] = goal_setting
-        loaded_payload['campaign']['catalog_item_ids'] = items
-        loaded_payload['campaign']['enabling_state'] = enabling_state
+        # Skips the rows finished by an earlier run
+        key = (ad_account_id, campaign_id)
+        if journal.Done(row_num, key) is not None:
+            resumed += 1
+            continue
 
         print("*********************************************")
-        print("updating campaign {0} - id: {1}".format(row_num, campaign_id))
-        print(UpdateCampaign(BASE_URL, ad_account_id, campaign_id, loaded_payload, token))
+        try:
+            # Lists the campaigns of the ad account when its first row is reached
+            if ad_account_id != indexed_ad_account_id:
+                campaign_index = RetryWithBackoff(IndexCampaigns, BASE_URL, ad_account_id, token)
+                indexed_ad_account_id = ad_account_id
+                listed_ad_accounts += 1
+
+            # Looks up current campaign info based on the campaign_id given from the file.
+            # Campaigns missing from the list are read one by one.
+            if campaign_id in campaign_index:
+                loaded_payload = {"campaign": campaign_index[campaign_id]}
+            else:
+                loaded_payload = json.loads(RetryWithBackoff(ReadCampaign, BASE_URL, ad_account_id, campaign_id, token))
+                read_calls += 1
+
+            # Compares campaign settings with the file
+            target_fields = TargetFields(campaign_title, schedule_start, schedule_end, daily_budget, goal_setting, items, enabling_state)
+            diff = CampaignDiff(loaded_payload['campaign'], target_fields)
+
+            if not diff:
+                print("campaign {0} - id: {1} is up to date, skipped".format(row_num, campaign_id))
+                print("*********************************************")
+                journal.Record(row_num, key, True, {"result": "up to date"})
+                continue
+
+            # Overwrites the changed campaign settings
+            for path in diff:
+                SetField(loaded_payload['campaign'], path, target_fields[path])
+
+            print("updating campaign {0} - id: {1}".format(row_num, campaign_id))
+            PrintDiff(diff)
+            response = RetryWithBackoff(UpdateCampaign, BASE_URL, ad_account_id, campaign_id, loaded_payload, token)
+            print(response)
+        except Exception as e:
+            response = {"error": repr(e)}
+            print("campaign {0} - id: {1} failed: {2}".format(row_num, campaign_id, response['error']))
         print("*********************************************")
 
-    return("Total {0} items are updated.".format(row_num+1))
+        if "campaign" in response:
+            journal.Record(row_num, key, True, {"result": "updated", "diff": ['.'.join(path) for path in diff]})
+            updated += 1
+        else:
+            journal.Record(row_num, key, False, {"result": "failed", "error": response})
+            failed += 1
+    journal.Close()
 
+    print("Campaigns loaded by listing the campaigns of {0} ad accounts and {1} single reads instead of {2} reads".format(listed_ad_accounts, read_calls, len(rows)))
+    return("Total {0} items are updated, {1} are up to date, {2} failed, {3} were finished by an earlier run.".format(
+        updated, len(rows)-updated-failed-resumed, failed, resumed))
 
 def main():
-    token = CreateToken(BASE_URL, EMAIL, PWD)
-    response = BulkUpdateCampaignsFromFile(token)
+    token = TokenProvider(BASE_URL, EMAIL, PWD)
+    response = BulkUpdateCampaignsFromFile(token, RESUME or "--resume" in sys.argv[1:])
     print(response)
+    http_client.PrintConnectionStats()
 
 
 if __name__ == '__main__':
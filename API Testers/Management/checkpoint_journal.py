@@ -0,0 +1,113 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Append-only checkpoint journal of the bulk scripts.
+# Every finished row is appended as one JSON line, keyed by its row number and the identity of its campaign,
+# so that a crashed or interrupted run can be resumed and skips the rows that already succeeded.
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+# Failed calls are retried up to RETRIES times, waiting BACKOFF_SECONDS, then twice as long every retry,
+# or as long as the Retry-After header of the response asks
+RETRIES = 4
+BACKOFF_SECONDS = 1
+
+# Responses with these status codes are retried: the API is overloaded or failed, and may answer the same call later
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CheckpointJournal:
+    # Without resume, a new journal is started and the previous one is overwritten
+    def __init__(self, path, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # The last line may be cut off by a crash
+                    self.entries[(entry['row_num'], tuple(entry['key']))] = entry
+        self.file = open(path, 'a' if resume else 'w')
+
+    # Get the result of a row that succeeded in an earlier run, or None
+    def Done(self, row_num, key):
+        entry = self.entries.get((row_num, tuple(key)))
+        if entry is not None and entry['status'] == "done":
+            return entry['result']
+        return None
+
+    def Record(self, row_num, key, done, result):
+        entry = {
+            "row_num": row_num,
+            "key": list(key),
+            "status": "done" if done else "failed",
+            "result": result,
+            "time": datetime.now().isoformat(timespec='seconds')
+        }
+        with self.lock:
+            self.entries[(row_num, tuple(key))] = entry
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def Close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+class RetryableStatus(Exception):
+    def __init__(self, response):
+        super().__init__("HTTP {0}: {1}".format(response.status_code, response.text[:200]))
+        self.response = response
+
+    # Seconds to wait from the Retry-After header, or None
+    def RetryAfter(self):
+        try:
+            return float(self.response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
+# Raise RetryableStatus for a response with one of RETRY_STATUS_CODES, so that RetryWithBackoff retries the call
+def RaiseForRetryableStatus(response):
+    if response.status_code in RETRY_STATUS_CODES:
+        raise RetryableStatus(response)
+    return response
+
+# Call the function, and retry it with exponential backoff while it fails on network errors, timeouts
+# or responses with one of RETRY_STATUS_CODES. Any other error, e.g. a 4xx body that is not JSON, is raised at once.
+def RetryWithBackoff(function, *args):
+    for attempt in range(RETRIES + 1):
+        try:
+            return function(*args)
+        except (RetryableStatus, requests.RequestException) as e:
+            if attempt == RETRIES:
+                raise
+            delay = BACKOFF_SECONDS * 2 ** attempt
+            if isinstance(e, RetryableStatus) and e.RetryAfter() is not None:
+                delay = max(delay, e.RetryAfter())
+            print("{0} failed: {1!r}, retrying in {2} seconds".format(function.__name__, e, delay))
+            time.sleep(delay)
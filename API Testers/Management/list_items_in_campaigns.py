@@ -14,8 +14,16 @@
 
 import csv
 import json
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import importlib.util
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+from token_provider import TokenProvider
+from checkpoint_journal import RaiseForRetryableStatus
 
 PLATFORM_NAME = "" # Platform name. e.g. MOLOCO
 PLATFORM_ID = "" # Platform ID e.g. MOLOCO_TEST
@@ -28,76 +36,140 @@ PWD = ""
 # Put where you want to store the file
 FILE_DIR = "./"
 
-# Get token based on the credential
-def CreateToken(base_url, email, pw):
-    url = base_url + "/tokens"
-    payload = {
-        "auth_type": "CREDENTIAL",
-        "credential_type_payload": {
-            "email": email,
-            "password": pw
-        }
-    }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json"
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    json_formatted = json.loads(response.text)
-    return (json_formatted['token'])
+# Number of ad accounts fetched at the same time, and the limit of API calls per second summed over all of them
+WORKERS = 8
+REQUESTS_PER_SECOND = 10
+
+# Campaign lists are parsed while they are downloaded when ijson is installed (pip install ijson),
+# so only one campaign is held in memory at a time. Without it, the whole response is parsed at once.
+STREAM_JSON = importlib.util.find_spec('ijson') is not None
+
+# Lists are returned page by page. Each response holds the token of the next page, which is sent back to get it.
+PAGE_TOKEN_PARAM = "page_token"
+NEXT_PAGE_TOKEN_FIELD = "next_page_token"
 
 # Get the list of ad accounts
-def ListAdAccount(base_url, token):
+def ListAdAccount(base_url, token, page_token=None):
     url = base_url + "/ad-accounts"
     headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + token
+        "accept": "application/json"
         }
-    response = requests.get(url, headers=headers) # Get list of ad accounts
+    params = {PAGE_TOKEN_PARAM: page_token} if page_token else None
+    response = RaiseForRetryableStatus(http_client.get(url, headers=headers, auth=token, params=params)) # Get list of ad accounts
     return(response.text)
 
 # Get the list of campaigns and campaigned items from certain ad account
-def ListCampaigns(base_url, ad_account_id, token):
+def ListCampaigns(base_url, ad_account_id, token, page_token=None, stream=False):
     url = base_url + "/ad-accounts/" + ad_account_id + "/campaigns?without_catalog_item_ids=false"
     headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + token
+        "accept": "application/json"
         }
-    response = requests.get(url, headers=headers) # Get list of campaigns
+    params = {PAGE_TOKEN_PARAM: page_token} if page_token else None
+    response = RaiseForRetryableStatus(http_client.get(url, headers=headers, auth=token, params=params, stream=stream)) # Get list of campaigns
+    if stream:
+        response.raise_for_status()
+        return(response)
     return(response.text)
 
+# Get the items of every page of a list. The next page is requested in the background while the current one is processed.
+def IterPages(fetch_page, field):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = json.loads(fetch_page(None))
+        while True:
+            next_page_token = page.get(NEXT_PAGE_TOKEN_FIELD)
+            next_page = executor.submit(fetch_page, next_page_token) if next_page_token else None
+            yield from page[field]
+            if next_page is None:
+                return
+            page = json.loads(next_page.result())
+
+# Get all the ad accounts in the platform one by one
+def IterAdAccounts(base_url, token):
+    return IterPages(lambda page_token: ListAdAccount(base_url, token, page_token), "ad_accounts")
+
+# Get the campaigns of certain ad account one by one.
+# With ijson, every page is parsed while it is downloaded, and the next page is requested as soon as its token is parsed.
+def IterCampaigns(base_url, ad_account_id, token):
+    if not STREAM_JSON:
+        yield from IterPages(lambda page_token: ListCampaigns(base_url, ad_account_id, token, page_token), "campaigns")
+        return
+    import ijson
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(ListCampaigns, base_url, ad_account_id, token, None, True)
+        while next_page is not None:
+            page, next_page, builder = next_page.result(), None, None
+            with page:
+                page.raw.decode_content = True # Decompress gzip responses while parsing
+                for prefix, event, value in ijson.parse(page.raw):
+                    if prefix == NEXT_PAGE_TOKEN_FIELD and value:
+                        next_page = executor.submit(ListCampaigns, base_url, ad_account_id, token, value, True)
+                    elif prefix.startswith("campaigns.item"):
+                        # Builds one campaign at a time from the parser events
+                        if prefix == "campaigns.item" and event == "start_map":
+                            builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                        if prefix == "campaigns.item" and event == "end_map":
+                            yield builder.value
+
+# Csv writer shared by the ad account threads. Rows are written as they arrive, in any order.
+class LockedWriter:
+    def __init__(self, csvfile):
+        self.writer = csv.writer(csvfile)
+        self.lock = threading.Lock()
+
+    def writerows(self, rows):
+        with self.lock:
+            self.writer.writerows(rows)
+
+# Write the campaigned items of an ad account, and get the number of items written
+def WriteCampaignedItems(ad_account_id, token, write):
+    count = 0
+    # Gets campaigns of the ad account, each one written before the next one is parsed
+    for campaign in IterCampaigns(BASE_URL, ad_account_id, token):
+        # Gets list of campaigned items
+        campaignedItems = campaign["catalog_item_ids"]
+        # Checks that list is not empty and the campaign is enabled(active)
+        if (len(campaignedItems) != 0 and campaign["enabling_state"] == "ENABLED"):
+            print("For ad account:{AD_ACCOUNT_ID} campaign:{CM_ID}, there are {COUNT} items in the campaign".format(AD_ACCOUNT_ID=ad_account_id, CM_ID=campaign['id'], COUNT=len(campaignedItems)))
+            write.writerows([ad_account_id, campaign['id'], item_ids] for item_ids in campaignedItems)
+            count += len(campaignedItems)
+    return count
+
 
 def main():
 
     # Open a csv file to write campaigned items
     file = FILE_DIR + "/" + datetime.now().strftime('%Y-%m-%dT%H:%M') + "_itemlist.csv"
-    csvfile = open(file, 'w', newline='')
-    write = csv.writer(csvfile)
-    # Column schema
-    write.writerow(['ad_account_id','campaign_id','campaigned_item_ids'])
-
-    campaignedItemList = list()
-    
-    # Gets token based on the credential
-    token = CreateToken(BASE_URL, EMAIL, PWD)
-    # Gets all the ad account in the platform
-    adAccountList = json.loads(ListAdAccount(BASE_URL, token))["ad_accounts"]
-    
-    for adaccount in adAccountList: 
-        # Gets list of campaigns of the ad account
-        campaigns = json.loads(ListCampaigns(BASE_URL, adaccount['id'], token))["campaigns"]
-        for campaign in campaigns:
-            # Gets list of campaigned items
-            campaignedItems = campaign["catalog_item_ids"]
-            # Checks that list is not empty and the campaign is enabled(active)
-            if (len(campaignedItems) != 0 and campaign["enabling_state"] == "ENABLED"):
-                print("For ad account:{AD_ACCOUNT_ID} campaign:{CM_ID}, there are {COUNT} items in the campaign".format(AD_ACCOUNT_ID=adaccount['id'], CM_ID=campaign['id'], COUNT=len(campaignedItems)))
-                campaignedItemList += campaignedItems
-                for item_ids in campaignedItems:
-                    write.writerow([adaccount['id'],campaign['id'], item_ids])
-        
-    print("Total {COUNT} campaigned items found".format(COUNT=len(campaignedItemList)))
-    
+    with open(file, 'w', newline='') as csvfile:
+        write = LockedWriter(csvfile)
+        # Column schema
+        write.writerows([['ad_account_id','campaign_id','campaigned_item_ids']])
+
+        campaignedItemCount = 0
+        failedAdAccounts = []
+
+        # Gets token based on the credential
+        token = TokenProvider(BASE_URL, EMAIL, PWD)
+        # Fetches the campaigns of all the ad accounts in the platform concurrently, while the ad accounts are listed
+        http_client.SetRequestsPerSecond(REQUESTS_PER_SECOND)
+        # Every worker and the ad account listing may have a page in flight and the next page prefetched
+        http_client.SetConcurrency(2 * (WORKERS + 1))
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            futures = {executor.submit(WriteCampaignedItems, adaccount['id'], token, write): adaccount['id'] for adaccount in IterAdAccounts(BASE_URL, token)}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    count = future.result()
+                    campaignedItemCount += count
+                    print("({DONE}/{TOTAL}) ad account:{AD_ACCOUNT_ID} done, {COUNT} items".format(DONE=done, TOTAL=len(futures), AD_ACCOUNT_ID=futures[future], COUNT=count))
+                except Exception as e:
+                    failedAdAccounts.append(futures[future])
+                    print("({DONE}/{TOTAL}) ad account:{AD_ACCOUNT_ID} failed: {ERROR!r}".format(DONE=done, TOTAL=len(futures), AD_ACCOUNT_ID=futures[future], ERROR=e))
+
+    print("Total {COUNT} campaigned items found".format(COUNT=campaignedItemCount))
+    if failedAdAccounts:
+        print("Failed ad accounts: {0}".format(failedAdAccounts))
+    http_client.PrintConnectionStats()
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
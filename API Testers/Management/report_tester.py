@@ -12,8 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import csv
 import json
-import requests
+import os
+import re
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+from token_provider import TokenProvider
+from checkpoint_journal import RaiseForRetryableStatus, RetryWithBackoff
+from list_items_in_campaigns import IterAdAccounts
 
 PLATFORM_NAME = "" # Platform name. e.g. MOLOCO
 PLATFORM_ID = "" # Platform ID e.g. MOLOCO_TEST
@@ -25,6 +39,22 @@ PWD = ""
 # Specify ad account id to get report from. If it is empty, QueryPlatformSummary will be called.
 AD_ACCOUNT_ID = "" 
 
+# Set BULK_REPORT = True to get the report of every ad account in AD_ACCOUNT_IDS, or of all the ad accounts in the
+# platform if it is empty. ACCOUNT_WORKERS ad accounts are queried at the same time, with at most REQUESTS_PER_SECOND calls.
+# The rows of all the ad accounts are written to EXPORT_PATH with an ad_account_id column, as soon as each ad account is done.
+# Use a .parquet path to write Parquet (requires pyarrow), any other path is written as csv.
+BULK_REPORT = False
+AD_ACCOUNT_IDS = []
+ACCOUNT_WORKERS = 4
+REQUESTS_PER_SECOND = 10
+EXPORT_PATH = "report.csv"
+
+# Columns of the export are ad_account_id, the grouping fields of the rows below as strings, the counts and amounts
+# of SUM_FIELDS as int64 and the rates of RATE_FIELDS as float64, all as dotted paths of the row fields. Every ad
+# account is written with the same columns: fields missing from a row are left empty, and a row with any other field
+# stops the export without querying the ad accounts that have not started yet.
+EXPORT_GROUP_FIELDS = ["date", "currency", "metric.spending.currency", "metric.revenue.currency"]
+
 # Put report API payload specification here.
 # For detailed spec, please refer below urls:
 # https://moloco-rmp.readme.io/reference/rmpmanagementapi_queryadaccountsummary
@@ -35,76 +65,391 @@ DATE_END = "2023-06-18"
 GROUP_BY = ["DATE", "CURRENCY"]
 ORDER_BY = ["TIME_DATE"]
 
-BASE_URL = "https://{NAME}-mgmt.rmp-api.moloco.com/rmp/mgmt/v1/platforms/{ID}".format(NAME=PLATFORM_NAME, ID=PLATFORM_ID)
+# Long date ranges are split into shards of SHARD_DAYS days (e.g. 1 for days, 7 for weeks), which are queried
+# concurrently and merged. Set SHARD_DAYS = 0 to query the whole range at once.
+SHARD_DAYS = 7
+SHARD_WORKERS = 4
 
+# Field of the report that holds the rows.
+# Shards are merged in date order, which keeps rows ordered by TIME_DATE. To sort the merged rows by other
+# ORDER_BY values, map each of them to the path of the row field it sorts by, e.g. {"CAMPAIGN_ID": ("campaign", "id")}.
+ROWS_FIELD = "rows"
+ORDER_FIELDS = {}
+
+# Metrics of the report rows, as dotted paths of the row fields, e.g. "metric.imp" for {"metric": {"imp": "10"}}.
+# When GROUP_BY has no DATE, the rows of different shards with the same grouping are merged: the counts and amounts
+# of SUM_FIELDS are summed, and the rates of RATE_FIELDS are computed again as numerator / denominator of the sums.
+# Every other field of a row is part of its grouping, e.g. date, currency or campaign id, so list every metric here:
+# merging stops at a field under METRIC_PREFIX that is in none of SUM_FIELDS, RATE_FIELDS and EXPORT_GROUP_FIELDS.
+# Unique counts, e.g. reach or unique users, can't be merged by summing. Query them with DATE in GROUP_BY or SHARD_DAYS = 0.
+SUM_FIELDS = ["metric.imp", "metric.click", "metric.conversion", "metric.spending.amount_micro", "metric.revenue.amount_micro"]
+RATE_FIELDS = {
+    "metric.ctr": ("metric.click", "metric.imp"),
+    "metric.cvr": ("metric.conversion", "metric.click"),
+    "metric.roas": ("metric.revenue.amount_micro", "metric.spending.amount_micro")
+}
+METRIC_PREFIX = "metric."
+
+# Report data of a date rarely changes once SETTLEMENT_DAYS have passed. Set REPORT_CACHE_PATH, e.g. to
+# "report_cache.sqlite", to keep the reports of settled dates per date in a local SQLite file, so that they are not
+# queried again. Only recent and missing dates are queried, in shards of SHARD_DAYS, and the rows are split by
+# their DATE_FIELD. The cache needs DATE in GROUP_BY, other groupings are always queried.
+REPORT_CACHE_PATH = ""
+SETTLEMENT_DAYS = 3
+DATE_FIELD = "date"
+
+BASE_URL = "https://{NAME}-mgmt.rmp-api.moloco.com/rmp/mgmt/v1/platforms/{ID}".format(NAME=PLATFORM_NAME, ID=PLATFORM_ID)
 
-def CreateToken(base_url, email, pw):
-    url = base_url + "/tokens"
-    payload = {
-        "auth_type": "CREDENTIAL",
-        "credential_type_payload": {
-            "email": email,
-            "password": pw
-        }
-    }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json"
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    json_formatted = json.loads(response.text)
-    print(json.dumps(json_formatted,indent=4))
-    return (json_formatted['token'])
 
 # To query report for an ad account
-def QueryAdAccountSummary(base_url, token, ad_account_id):
+def QueryAdAccountSummary(base_url, token, ad_account_id, date_start=DATE_START, date_end=DATE_END):
     url = base_url + "/ad-accounts/" + ad_account_id + "/report"
     headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + token
+        "accept": "application/json"
         }
     payload = {
         "timezone": TIMEZONE,
-        "date_start": DATE_START,
-        "date_end": DATE_END,
+        "date_start": date_start,
+        "date_end": date_end,
         "group_by": GROUP_BY,
         "order_by": ORDER_BY
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = RaiseForRetryableStatus(http_client.post(url, json=payload, headers=headers, auth=token))
     return(response.text)
 
 # To query report for the platform
-def QueryPlatformSummary(base_url, token):
+def QueryPlatformSummary(base_url, token, date_start=DATE_START, date_end=DATE_END):
     url = base_url + "/report"
     headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + token
+        "accept": "application/json"
         }
     payload = {
         "timezone": TIMEZONE,
-        "date_start": DATE_START,
-        "date_end": DATE_END,
+        "date_start": date_start,
+        "date_end": date_end,
         "group_by": GROUP_BY,
         "order_by": ORDER_BY
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = RaiseForRetryableStatus(http_client.post(url, json=payload, headers=headers, auth=token))
     return(response.text)
 
 
+# Split the date range into shards of shard_days days, the last one may be shorter
+def DateShards(date_start, date_end, shard_days):
+    if not shard_days:
+        return [(date_start, date_end)]
+    start = date.fromisoformat(date_start)
+    end = date.fromisoformat(date_end)
+    shards = []
+    while start <= end:
+        shard_end = min(start + timedelta(days=shard_days - 1), end)
+        shards.append((start.isoformat(), shard_end.isoformat()))
+        start = shard_end + timedelta(days=1)
+    return shards
+
+# Query the report of one shard, for the ad account or for the platform
+def QueryShard(base_url, token, ad_account_id, date_start, date_end):
+    if ad_account_id == "":
+        response = QueryPlatformSummary(base_url, token, date_start, date_end)
+    else:
+        response = QueryAdAccountSummary(base_url, token, ad_account_id, date_start, date_end)
+    report = json.loads(response)
+    if ROWS_FIELD not in report:
+        raise ValueError("report of {0} - {1} has no {2}: {3}".format(date_start, date_end, ROWS_FIELD, response))
+    return report
+
+def Leaves(row, path=()):
+    for key, value in row.items():
+        if isinstance(value, dict):
+            yield from Leaves(value, path + (key,))
+        else:
+            yield path + (key,), value
+
+def GetLeaf(row, path):
+    for key in path:
+        if not isinstance(row, dict):
+            return None
+        row = row.get(key)
+    return row
+
+def SetLeaf(row, path, value):
+    for key in path[:-1]:
+        row = row.setdefault(key, {})
+    row[path[-1]] = value
+
+def FieldPath(field):
+    return tuple(field.split("."))
+
+# Number of a metric value. int64 values are strings of digits in the API's JSON.
+def ToNumber(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return float(value) if re.search(r"[.eE]", value) else int(value)
+    return value
+
+# Sum of two metric values, in the type of the first one
+def AddMetric(current, value):
+    if current is None:
+        return value
+    if value is None:
+        return current
+    total = ToNumber(current) + ToNumber(value)
+    return str(total) if isinstance(current, str) else total
+
+# The grouping of a row: all its fields that are not metrics
+def GroupKey(row):
+    metrics = set(SUM_FIELDS) | set(RATE_FIELDS)
+    return tuple((path, json.dumps(value)) for path, value in Leaves(row) if ".".join(path) not in metrics)
+
+# Raise for a field under METRIC_PREFIX that is not declared, since it would be taken as grouping and not summed
+def CheckMetricsDeclared(row):
+    declared = set(SUM_FIELDS) | set(RATE_FIELDS) | set(EXPORT_GROUP_FIELDS)
+    for path, value in Leaves(row):
+        field = ".".join(path)
+        if field.startswith(METRIC_PREFIX) and field not in declared:
+            raise ValueError("rows of different shards can't be merged with the undeclared metric {0}, add it to SUM_FIELDS or "
+                             "RATE_FIELDS, or to EXPORT_GROUP_FIELDS if it is not a metric. A unique count can't be summed, "
+                             "query it with DATE in GROUP_BY or SHARD_DAYS = 0".format(field))
+
+# Merge rows with the same grouping into one row. Rows with a grouping of their own are kept as they are.
+def ReaggregateRows(rows):
+    groups = {}
+    for row in rows:
+        CheckMetricsDeclared(row)
+        groups.setdefault(GroupKey(row), []).append(row)
+    merged_rows = []
+    for group in groups.values():
+        if len(group) == 1:
+            merged_rows.append(group[0])
+            continue
+        merged = copy.deepcopy(group[0])
+        for row in group[1:]:
+            for field in SUM_FIELDS:
+                path = FieldPath(field)
+                if GetLeaf(row, path) is not None:
+                    SetLeaf(merged, path, AddMetric(GetLeaf(merged, path), GetLeaf(row, path)))
+        for field, (numerator, denominator) in RATE_FIELDS.items():
+            path = FieldPath(field)
+            if GetLeaf(merged, path) is None:
+                continue
+            total = ToNumber(GetLeaf(merged, FieldPath(numerator)))
+            base = ToNumber(GetLeaf(merged, FieldPath(denominator)))
+            rate = total / base if total is not None and base else None
+            SetLeaf(merged, path, str(rate) if isinstance(GetLeaf(merged, path), str) and rate is not None else rate)
+        merged_rows.append(merged)
+    return merged_rows
+
+# Merge the reports of the shards, given in date order.
+# With DATE in GROUP_BY the rows of different shards never share a grouping and are only concatenated.
+def MergeReports(reports):
+    if len(reports) == 1:
+        return reports[0]
+    merged = dict(reports[0])
+    rows = [row for report in reports for row in report[ROWS_FIELD]]
+    if "DATE" not in GROUP_BY:
+        rows = ReaggregateRows(rows)
+    for order in reversed(ORDER_BY):
+        if order in ORDER_FIELDS:
+            rows.sort(key=lambda row: (GetLeaf(row, ORDER_FIELDS[order]) is None, GetLeaf(row, ORDER_FIELDS[order])))
+    merged[ROWS_FIELD] = rows
+    return merged
+
+# Query the reports of the shards, SHARD_WORKERS shards at the same time
+def QueryShards(base_url, token, ad_account_id, shards):
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+        futures = [executor.submit(RetryWithBackoff, QueryShard, base_url, token, ad_account_id, shard_start, shard_end)
+                   for shard_start, shard_end in shards]
+        reports = [future.result() for future in futures]
+    for (shard_start, shard_end), report in zip(shards, reports):
+        print("{0} - {1}: {2} rows".format(shard_start, shard_end, len(report[ROWS_FIELD])))
+    return reports
+
+# Reports are cached per platform, ad account, timezone, grouping and date
+def OpenReportCache(path):
+    connection = sqlite3.connect(path)
+    connection.execute("""CREATE TABLE IF NOT EXISTS report_cache (
+        platform_id TEXT, ad_account_id TEXT, timezone TEXT, group_by TEXT, date TEXT, report TEXT, fetched_at TEXT,
+        PRIMARY KEY (platform_id, ad_account_id, timezone, group_by, date))""")
+    return connection
+
+def CachedReports(connection, ad_account_id, dates):
+    reports = {}
+    for day in dates:
+        row = connection.execute("SELECT report FROM report_cache WHERE platform_id = ? AND ad_account_id = ? AND timezone = ? AND group_by = ? AND date = ?",
+                                 (PLATFORM_ID, ad_account_id, TIMEZONE, json.dumps(GROUP_BY), day)).fetchone()
+        if row is not None:
+            reports[day] = json.loads(row[0])
+    return reports
+
+def StoreReports(connection, ad_account_id, reports):
+    fetched_at = datetime.now().isoformat(timespec='seconds')
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO report_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(PLATFORM_ID, ad_account_id, TIMEZONE, json.dumps(GROUP_BY), day, json.dumps(report), fetched_at)
+                                for day, report in reports.items()])
+
+# Date of a report row as YYYY-MM-DD, from a date string or a {"year", "month", "day"} object
+def RowDate(row):
+    value = GetLeaf(row, FieldPath(DATE_FIELD))
+    if isinstance(value, dict):
+        return "{0:04d}-{1:02d}-{2:02d}".format(int(value['year']), int(value['month']), int(value['day']))
+    if not isinstance(value, str):
+        raise ValueError("report row has no {0}: {1}".format(DATE_FIELD, json.dumps(row)))
+    return value[:10]
+
+# Split the report of a shard into one report per date of the shard. Dates without rows get an empty report.
+def SplitReportByDate(shard_start, shard_end, report):
+    reports = {day: dict(report, **{ROWS_FIELD: []}) for day, _ in DateShards(shard_start, shard_end, 1)}
+    for row in report[ROWS_FIELD]:
+        day = RowDate(row)
+        if day not in reports:
+            raise ValueError("row of {0} in the report of {1} - {2}".format(day, shard_start, shard_end))
+        reports[day][ROWS_FIELD].append(row)
+    return reports
+
+# Split the dates into shards of SHARD_DAYS that cover only consecutive dates
+def MissingDateShards(dates):
+    runs = []
+    for day in dates:
+        if runs and date.fromisoformat(day) == date.fromisoformat(runs[-1][1]) + timedelta(days=1):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [shard for run_start, run_end in runs for shard in DateShards(run_start, run_end, SHARD_DAYS)]
+
+# Query the report of every date that is not settled or not cached yet, and merge it with the cached dates
+def QueryCachedReport(base_url, token, ad_account_id):
+    dates = [day for day, _ in DateShards(DATE_START, DATE_END, 1)]
+    settled_before = (datetime.now(ZoneInfo(TIMEZONE)).date() - timedelta(days=SETTLEMENT_DAYS)).isoformat()
+    with closing(OpenReportCache(REPORT_CACHE_PATH)) as connection:
+        reports = CachedReports(connection, ad_account_id, [day for day in dates if day < settled_before])
+        cached = len(reports)
+        shards = MissingDateShards([day for day in dates if day not in reports])
+        queried = {}
+        for (shard_start, shard_end), report in zip(shards, QueryShards(base_url, token, ad_account_id, shards)):
+            queried.update(SplitReportByDate(shard_start, shard_end, report))
+        StoreReports(connection, ad_account_id, {day: report for day, report in queried.items() if day < settled_before})
+    print("{0} dates from the cache, {1} dates queried in {2} shards".format(cached, len(queried), len(shards)))
+    reports.update(queried)
+    return MergeReports([reports[day] for day in dates])
+
+# Query the report from DATE_START to DATE_END shard by shard
+def QueryShardedReport(base_url, token, ad_account_id):
+    if REPORT_CACHE_PATH and "DATE" in GROUP_BY:
+        return QueryCachedReport(base_url, token, ad_account_id)
+    return MergeReports(QueryShards(base_url, token, ad_account_id, DateShards(DATE_START, DATE_END, SHARD_DAYS)))
+
+# Columns of the export, in order
+def ExportColumns():
+    return ["ad_account_id"] + EXPORT_GROUP_FIELDS + SUM_FIELDS + list(RATE_FIELDS)
+
+# Flatten a report row into the export columns, with SUM_FIELDS as int, RATE_FIELDS as float and the other fields as strings
+def FlattenRow(ad_account_id, row):
+    flat = dict.fromkeys(ExportColumns())
+    flat["ad_account_id"] = ad_account_id
+    for path, value in Leaves(row):
+        column = ".".join(path)
+        if column not in flat or column == "ad_account_id":
+            raise ValueError("report of ad account {0} has the column {1}, add it to EXPORT_GROUP_FIELDS, SUM_FIELDS or RATE_FIELDS".format(
+                ad_account_id, column))
+        if value is None:
+            continue
+        if column in SUM_FIELDS:
+            value = ToNumber(value)
+            if value != int(value):
+                raise ValueError("report of ad account {0} has the non-integer {1} {2}, move it to RATE_FIELDS".format(
+                    ad_account_id, column, value))
+            value = int(value)
+        elif column in RATE_FIELDS:
+            value = float(ToNumber(value))
+        elif isinstance(value, list):
+            value = json.dumps(value)
+        else:
+            value = str(value)
+        flat[column] = value
+    return flat
+
+# Writes the rows of the ad accounts to one csv or Parquet file, batch by batch, with the columns of ExportColumns
+class ReportWriter:
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.columns = ExportColumns()
+        self.file = None
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            types = dict.fromkeys(SUM_FIELDS, pa.int64()) | dict.fromkeys(RATE_FIELDS, pa.float64())
+            self.schema = pa.schema([(column, types.get(column, pa.string())) for column in self.columns])
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            self.file = open(self.path, 'w', newline='')
+            self.writer = csv.DictWriter(self.file, fieldnames=self.columns)
+            self.writer.writeheader()
+
+    def Write(self, rows):
+        if not rows:
+            return
+        if self.parquet:
+            import pyarrow as pa
+            self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+        else:
+            self.writer.writerows(rows)
+
+    def Close(self):
+        if self.parquet:
+            self.writer.close()
+        if self.file is not None:
+            self.file.close()
+
+# Query the report of every ad account and write its rows to EXPORT_PATH
+def BulkReport(base_url, token):
+    ad_account_ids = AD_ACCOUNT_IDS or [ad_account['id'] for ad_account in IterAdAccounts(base_url, token)]
+    http_client.SetRequestsPerSecond(REQUESTS_PER_SECOND)
+    http_client.SetConcurrency(ACCOUNT_WORKERS * SHARD_WORKERS)
+    writer = ReportWriter(EXPORT_PATH)
+    rows = 0
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=ACCOUNT_WORKERS) as executor:
+            futures = {executor.submit(QueryShardedReport, base_url, token, ad_account_id): ad_account_id for ad_account_id in ad_account_ids}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    ad_account_id = futures[future]
+                    try:
+                        report = future.result()
+                    except Exception as e:
+                        failed.append(ad_account_id)
+                        print("({0}/{1}) ad account:{2} failed: {3!r}".format(done, len(futures), ad_account_id, e))
+                        continue
+                    writer.Write([FlattenRow(ad_account_id, row) for row in report[ROWS_FIELD]])
+                    rows += len(report[ROWS_FIELD])
+                    print("({0}/{1}) ad account:{2} done, {3} rows".format(done, len(futures), ad_account_id, len(report[ROWS_FIELD])))
+            except BaseException:
+                # Only the ad accounts being queried are waited for
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        writer.Close()
+    if failed:
+        print("Failed ad accounts: {0}".format(failed))
+    return("Total {0} rows of {1} ad accounts are written to {2}.".format(rows, len(ad_account_ids) - len(failed), EXPORT_PATH))
+
+
 def main():
     # Get token to call management APIs
-    token = CreateToken(BASE_URL, EMAIL, PWD)
+    token = TokenProvider(BASE_URL, EMAIL, PWD)
 
-    # If the ad account id is not provided, then call QueryPlatformSummary. 
+    # In bulk mode, export the report of every ad account.
+    # Else if the ad account id is not provided, then call QueryPlatformSummary.
     # Else call QueryAdAccountSummary with given ad account id.
-    if AD_ACCOUNT_ID == "": 
-        response = QueryPlatformSummary(BASE_URL, token)
-        json_formatted = json.loads(response)
-        print(json.dumps(json_formatted,indent=4))
+    if BULK_REPORT:
+        print(BulkReport(BASE_URL, token))
     else:
-        response = QueryAdAccountSummary(BASE_URL, token, AD_ACCOUNT_ID)
-        json_formatted = json.loads(response)
+        json_formatted = QueryShardedReport(BASE_URL, token, AD_ACCOUNT_ID)
         print(json.dumps(json_formatted,indent=4))
+    http_client.PrintConnectionStats()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Management API token shared by the management scripts.
+# The token is cached on disk with its expiry, so short script runs reuse it instead of asking for a new one,
+# it is refreshed shortly before it expires, and a call answered with 401 is retried once with a new token.
+#
+# Pass the provider as `auth` of the calls:
+#     token = TokenProvider(BASE_URL, EMAIL, PWD)
+#     http_client.get(url, headers=headers, auth=token)
+
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from requests.auth import AuthBase
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+
+# Tokens are cached per platform and email in this file, readable by the current user only
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".rmp_token_cache.json")
+
+# Lifetime assumed for tokens that do not carry their expiry, and how long before expiry a token is refreshed
+TOKEN_TTL_SECONDS = 3600
+REFRESH_MARGIN_SECONDS = 300
+
+
+# Get token based on the credential
+def CreateToken(base_url, email, pw):
+    url = base_url + "/tokens"
+    payload = {
+        "auth_type": "CREDENTIAL",
+        "credential_type_payload": {
+            "email": email,
+            "password": pw
+        }
+    }
+    headers = {
+        "accept": "application/json",
+        "content-type": "application/json"
+    }
+    response = http_client.post(url, json=payload, headers=headers)
+    json_formatted = json.loads(response.text)
+    return (json_formatted['token'])
+
+# Expiry of a JWT token from its exp claim, or TOKEN_TTL_SECONDS from now for other tokens
+def TokenExpiry(token):
+    try:
+        claims = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(claims + "=" * (-len(claims) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + TOKEN_TTL_SECONDS
+
+def ReadTokenCache():
+    try:
+        with open(TOKEN_CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Replace the cache file at once, created with 0600 permissions
+def WriteTokenCache(cache):
+    temp_path = TOKEN_CACHE_PATH + ".tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.chmod(temp_path, 0o600)
+    os.replace(temp_path, TOKEN_CACHE_PATH)
+
+
+class TokenProvider(AuthBase):
+    def __init__(self, base_url, email, pw):
+        self.base_url = base_url
+        self.email = email
+        self.pw = pw
+        self.cache_key = base_url + " " + email
+        self.lock = threading.Lock()
+        cached = ReadTokenCache().get(self.cache_key, {})
+        self.token = cached.get('token')
+        self.expires_at = cached.get('expires_at', 0)
+
+    # Get a valid token, refreshed when it expires within REFRESH_MARGIN_SECONDS
+    def Token(self):
+        with self.lock:
+            if self.token is None or time.time() > self.expires_at - REFRESH_MARGIN_SECONDS:
+                self.Refresh()
+            return self.token
+
+    # Create a new token and cache it. Must be called with the lock held.
+    def Refresh(self):
+        self.token = CreateToken(self.base_url, self.email, self.pw)
+        self.expires_at = TokenExpiry(self.token)
+        cache = ReadTokenCache()
+        cache[self.cache_key] = {"token": self.token, "expires_at": self.expires_at}
+        WriteTokenCache(cache)
+
+    # Refresh the token after a 401, unless another thread already replaced the rejected token
+    def Rejected(self, token):
+        with self.lock:
+            if self.token == token:
+                self.Refresh()
+            return self.token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = "Bearer " + self.Token()
+        request.register_hook('response', self.RetryOn401)
+        return request
+
+    def RetryOn401(self, response, **kwargs):
+        if response.status_code != 401 or getattr(response.request, 'token_retried', False):
+            return response
+        rejected = response.request.headers['Authorization'][len("Bearer "):]
+        request = response.request.copy()
+        request.headers['Authorization'] = "Bearer " + self.Rejected(rejected)
+        request.token_retried = True
+        response.content # Read the body, so the connection is released to the pool
+        response.close()
+        retried = response.connection.send(request, **kwargs)
+        retried.history.append(response)
+        retried.request = request
+        return retried
@@ -0,0 +1,154 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared HTTP client of the API Testers scripts.
+# All calls go through one keep-alive requests.Session, so a script that calls the API many times
+# opens one TCP+TLS connection per host (and per concurrent request) instead of one per call.
+#
+# The scripts import it from the parent directory:
+#     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+#     import http_client
+
+import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+# Number of hosts to keep connection pools for, and connections kept open per host.
+# Scripts that call the same host from more threads raise the pool size with SetConcurrency.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+
+HEADERS = {
+    "accept-encoding": "gzip, deflate"
+}
+
+# Seconds to wait for a connection, and for the server between two reads, unless a call passes its own timeout.
+# A stalled connection then raises instead of blocking its thread forever.
+TIMEOUT = (10, 60)
+
+_lock = threading.Lock()
+_pools = []
+_session = None
+_pool_maxsize = 0
+_rate_limiter = None
+
+
+# Connection pools that register themselves, so their connection counts can be reported
+# even after the pool manager dropped them.
+class CountedHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with _lock:
+            _pools.append(self)
+
+class CountedHTTPSConnectionPool(HTTPSConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with _lock:
+            _pools.append(self)
+
+class CountedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountedHTTPConnectionPool,
+            "https": CountedHTTPSConnectionPool
+        }
+
+# Spaces out calls evenly so that, summed over all threads, at most `rate` calls start per second
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Seconds until the next call may start, reserving that start for the caller
+    def Delay(self):
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(self.next_call, now)
+            self.next_call = call_at + self.interval
+        return max(call_at - now, 0)
+
+    def wait(self):
+        time.sleep(self.Delay())
+
+# Limit every call made through this module. A rate of 0 or None removes the limit.
+def SetRequestsPerSecond(rate):
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rate) if rate else None
+
+# Keep enough connections open per host for `concurrency` calls in flight at the same time, e.g. the number of
+# threads of a script. The pool only grows, so other callers of the shared session keep at least what they asked for.
+# If the session is already in use, its adapter is replaced by a larger one.
+def SetConcurrency(concurrency):
+    global _pool_maxsize
+    with _lock:
+        if concurrency <= max(_pool_maxsize, POOL_MAXSIZE):
+            return
+        _pool_maxsize = concurrency
+        if _session is not None:
+            MountAdapter(_session)
+
+# Must be called with the lock held
+def MountAdapter(session):
+    adapter = CountedHTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=max(_pool_maxsize, POOL_MAXSIZE))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+# Get the shared session, created on first use
+def GetSession():
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            MountAdapter(session)
+            session.headers.update(HEADERS)
+            _session = session
+    return _session
+
+def request(method, url, **kwargs):
+    if _rate_limiter is not None:
+        _rate_limiter.wait()
+    kwargs.setdefault("timeout", TIMEOUT)
+    return GetSession().request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+# Count requests and connections per host since the session was created
+def ConnectionStats():
+    stats = {}
+    with _lock:
+        pools = list(_pools)
+    for pool in pools:
+        host = stats.setdefault(pool.host, {"requests": 0, "opened": 0, "reused": 0})
+        host["requests"] += pool.num_requests
+        host["opened"] += pool.num_connections
+    for host in stats.values():
+        host["reused"] = max(host["requests"] - host["opened"], 0)
+    return stats
+
+def PrintConnectionStats():
+    for host, stats in ConnectionStats().items():
+        print("{HOST}: {REQUESTS} requests, {OPENED} connections opened, {REUSED} reused".format(
+            HOST=host, REQUESTS=stats["requests"], OPENED=stats["opened"], REUSED=stats["reused"]))
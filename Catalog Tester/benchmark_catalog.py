@@ -0,0 +1,251 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor
+import catalog_validator as cv
+import datetime
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import platform
+import resource
+import time
+
+# Catalog sizes to benchmark. The 10M and 50M row catalogs take several GB of disk and a long time to generate
+# and validate, so they are only added with RUN_LARGE_SIZES = True.
+SIZES = [10000, 100000, 1000000]
+LARGE_SIZES = [10000000, 50000000]
+RUN_LARGE_SIZES = False
+
+# Share of rows with one malformed value, and the seed of the synthetic catalog.
+ERROR_RATE = 0.01
+SEED = 42
+
+# Synthetic catalogs are generated once into BENCH_DIR and reused by later runs.
+BENCH_DIR = 'bench'
+
+# Every phase of every run is appended as one JSON line, so runs can be compared with each other.
+RESULTS_FILENAME = 'bench_results.jsonl'
+
+# Free-form label stored with the results, e.g. the change being measured.
+LABEL = ''
+
+# Rows generated at a time.
+GENERATE_CHUNKSIZE = 1000000
+
+# Malformed values injected into the synthetic catalog, per column.
+BAD_VALUES = {
+    'id': 'x' * 51,
+    'seller_id': 's' * 51,
+    'title': 't' * 201,
+    'normal_price': '12.5',
+    'price_pc': 'free',
+    'link': 'http://shop.example.com/products/1',
+    'image_link': 'https://cdn example com/1.jpg',
+    'category': 'Women Shoes',
+    'review_count': 'many',
+    'rating': 'good',
+    'brand': 'b' * 71,
+    'longtail_yn': 'y',
+    'updated_at': '2023/06/01 10:00:00',
+    'availability': 'sold_out',
+    'blocked': 'hidden'}
+
+#
+#
+# Synthetic catalog
+#
+#
+def zipf_choice(rng, count, size):
+    """
+    Indexes in [0, count) where a few values are very common, like sellers, brands and categories.
+    """
+    return (rng.zipf(1.3, size) - 1) % count
+
+def generate_chunk(rng, start, rows, error_rate):
+    ids = pd.Series(np.arange(start, start + rows)).map('P{0:09d}'.format)
+    sellers = zipf_choice(rng, max(rows // 1000, 10), rows)
+    products = rng.integers(0, max(start + rows, 1), rows)
+    categories = zipf_choice(rng, 500, rows)
+    blocked = rng.choice(['', 'in_stock', 'unavailable'], rows, p=[0.9, 0.08, 0.02])
+    batches = pd.Timestamp('2023-06-01') + pd.to_timedelta(rng.integers(0, 48, rows), unit='h')
+
+    chunk = pd.DataFrame({
+        'id': ids,
+        'seller_id': pd.Series(sellers).map('S{0:06d}'.format),
+        'seller_name': np.where(blocked == 'unavailable', 'undefined', pd.Series(sellers).map('Seller {0}'.format)),
+        'title': 'Item ' + ids + ' ' + pd.Series(rng.choice(['Sneakers', 'Shirt', 'Bag', 'Watch', 'Lamp'], rows)),
+        'normal_price': rng.integers(10, 10000, rows) * 100,
+        'price_pc': np.round(rng.uniform(1000, 1000000, rows), 2),
+        'link': 'https://shop.example.com/products/' + pd.Series(products).astype(str),
+        'image_link': 'https://cdn.example.com/img/' + pd.Series(products // 4).astype(str) + '.jpg',
+        'category': pd.Series(categories).map('Category{0}>Sub{0}>Leaf{0}'.format),
+        'review_count': rng.integers(0, 5000, rows),
+        'rating': np.round(rng.uniform(1, 5, rows), 1),
+        'shipping': rng.choice([0.0, 2500.0, 3000.0], rows),
+        'brand': pd.Series(zipf_choice(rng, 2000, rows)).map('Brand{0}'.format),
+        'longtail_yn': rng.choice(['Y', 'N'], rows),
+        'updated_at': pd.Series(batches.strftime(cv.DATETIME_FORMAT)),
+        'availability': rng.choice(['', 'in_stock', 'out_of_stock'], rows, p=[0.1, 0.8, 0.1]),
+        'blocked': blocked}).astype(str)
+
+    broken = np.flatnonzero(rng.random(rows) < error_rate)
+    columns = rng.choice(list(BAD_VALUES), len(broken))
+    for row, column in zip(broken, columns):
+        chunk.iat[row, chunk.columns.get_loc(column)] = BAD_VALUES[column]
+    return chunk
+
+def generate_catalog(filename, rows, error_rate=ERROR_RATE, seed=SEED, chunksize=GENERATE_CHUNKSIZE):
+    """
+    Writes a synthetic TSV catalog. The same rows, error_rate and seed always give the same file.
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, chunksize):
+        chunk = generate_chunk(rng, start, min(chunksize, rows - start), error_rate)
+        chunk.to_csv(filename, sep='\t', index=False, header=start == 0, mode='w' if start == 0 else 'a')
+
+def synthetic_catalog(rows, error_rate=ERROR_RATE, seed=SEED):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    filename = os.path.join(BENCH_DIR, 'catalog_{0}_{1}_{2}.tsv'.format(rows, error_rate, seed))
+    if not os.path.exists(filename):
+        generate_catalog(filename, rows, error_rate, seed)
+    return filename
+
+#
+#
+# Benchmark phases
+#
+# Every phase runs in a fresh process, so the peak RSS belongs to that phase only.
+#
+#
+def peak_rss_mib():
+    """
+    Peak resident memory of this process and of its largest child process, in MiB.
+    ru_maxrss (KiB on Linux) carries over the parent's peak into a spawned process,
+    so this process is measured with VmHWM where /proc is available.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except OSError:
+        pass
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+def bench_load(filename):
+    start = time.perf_counter()
+    rows = sum(len(chunk) for chunk in cv.read_catalog(filename, cv.CHUNKSIZE))
+    return {'seconds': time.perf_counter() - start, 'rows': rows}
+
+def bench_rules(filename):
+    """
+    Times loading and every rule separately in a single process.
+    """
+    load_seconds = 0
+    rule_seconds = {rule.__name__: 0 for rule in cv.RULES}
+    rows = 0
+    chunks = cv.read_catalog(filename, cv.CHUNKSIZE)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        load_seconds += time.perf_counter() - start
+        if chunk is None:
+            break
+        rows += len(chunk)
+        for rule in cv.RULES:
+            start = time.perf_counter()
+            rule(chunk)
+            rule_seconds[rule.__name__] += time.perf_counter() - start
+    return {'seconds': load_seconds + sum(rule_seconds.values()), 'rows': rows,
+            'load_seconds': load_seconds, 'rule_seconds': rule_seconds}
+
+def bench_end_to_end(filename):
+    # The CSV report goes next to the catalog in BENCH_DIR, and the index of the real catalog is left alone.
+    csv_filename = os.path.splitext(filename)[0] + '_report.csv'
+    start = time.perf_counter()
+    report = cv.validate_file(filename, cv.WORKERS, incremental=False, csv_filename=csv_filename)
+    return {'seconds': time.perf_counter() - start, 'rows': report['rows'],
+            'failed': {name: result['failed_count'] for name, result in report['rules'].items()}}
+
+PHASES = {
+    'load': bench_load,
+    'rules': bench_rules,
+    'end_to_end': bench_end_to_end}
+
+def run_phase(phase, filename):
+    result = PHASES[phase](filename)
+    result['peak_rss_mib'] = peak_rss_mib()
+    return result
+
+def run_in_new_process(function, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+def run_benchmark(sizes=None, results_filename=RESULTS_FILENAME):
+    sizes = (SIZES + LARGE_SIZES if RUN_LARGE_SIZES else SIZES) if sizes is None else sizes
+    run = {
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'label': LABEL,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'workers': cv.WORKERS,
+        'chunksize': cv.CHUNKSIZE,
+        'error_rate': ERROR_RATE,
+        'seed': SEED}
+    results = []
+    for size in sizes:
+        # Generating is done in a separate process as well, to keep this process small.
+        filename = run_in_new_process(synthetic_catalog, size)
+        for phase in PHASES:
+            result = run_in_new_process(run_phase, phase, filename)
+            result = run | {'size': size, 'phase': phase} | result
+            result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else None
+            print('{0:>10} rows  {1:<12} {2:>9.2f} s  {3:>12.0f} rows/s  {4:>9.1f} MiB'.format(
+                size, phase, result['seconds'], result['rows_per_second'] or 0, result['peak_rss_mib']))
+            with open(results_filename, 'a', encoding='utf8') as f:
+                f.write(json.dumps(result) + '\n')
+            results.append(result)
+    return results
+
+def print_comparison(results_filename=RESULTS_FILENAME):
+    """
+    Compares the last two runs in the results file, phase by phase.
+    """
+    with open(results_filename, encoding='utf8') as f:
+        results = [json.loads(line) for line in f]
+    runs = sorted({result['run_at'] for result in results})[-2:]
+    if len(runs) < 2:
+        return
+    by_key = {(result['run_at'], result['size'], result['phase']): result for result in results}
+    print('Comparing run', runs[1], 'with', runs[0])
+    for (run_at, size, phase), result in sorted(by_key.items(), key=lambda item: (item[0][1], item[0][2])):
+        previous = by_key.get((runs[0], size, phase))
+        if run_at == runs[1] and previous:
+            change = '{0:>+7.1%}'.format(result['seconds'] / previous['seconds'] - 1) if previous['seconds'] else '{0:>7}'.format('n/a')
+            print('{0:>10} rows  {1:<12} {2:>9.2f} s -> {3:>9.2f} s  {4}  {5:>9.1f} -> {6:>9.1f} MiB'.format(
+                size, phase, previous['seconds'], result['seconds'], change,
+                previous['peak_rss_mib'], result['peak_rss_mib']))
+
+
+def main():
+    run_benchmark()
+    print_comparison()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,917 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pandas import read_csv, to_datetime
+import contextlib
+import csv
+import datetime
+import functools
+import importlib.util
+import io
+import itertools
+import json
+import mmap
+import numpy as np
+import os
+import pandas as pd
+import re
+import shutil
+import validators
+
+# Catalog file to validate. Besides TSV, Parquet and Feather / Arrow IPC files are read by their extension.
+FILENAME = 'item_catalog.tsv'
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.feather', '.arrow', '.ipc')
+
+# Number of rows read and validated at a time. Memory use is bounded by the chunk size,
+# not by the size of the catalog file. Set to None to load the whole file at once.
+CHUNKSIZE = 1000000
+
+# Number of processes validating the catalog in parallel. The file is split into byte ranges aligned to
+# row boundaries (or row groups and record batches of columnar files), one per process.
+# Set to 1 to validate in the current process.
+WORKERS = os.cpu_count()
+
+# Number of failing rows kept as samples for each rule.
+SAMPLE_SIZE = 5
+
+# Number of failing row numbers and ids kept in the JSON report for each rule.
+# Every failing row is written to the CSV report as it is found, so memory use does not grow with the failures.
+MAX_FAILED_IDS = 1000
+
+# Report files. The JSON report has the failure count, the first failing rows and ids and sample rows of every rule,
+# the CSV report has one line per failing row and rule. Set to None to skip writing a report.
+REPORT_JSON = 'catalog_report.json'
+REPORT_CSV = 'catalog_report.csv'
+
+# link and image_link validation. validators.url results are kept in an LRU cache of URL_CACHE_SIZE urls,
+# and with UNIQUE_URLS each distinct url of a chunk is validated only once.
+MAX_URL_LENGTH = 2000
+URL_CACHE_SIZE = 1000000
+UNIQUE_URLS = True
+
+# Incremental validation. With INCREMENTAL, only rows that are new or changed since the last successful run
+# are validated, using the id -> row hash index kept in INDEX_DIR. Added, changed and removed ids are counted in the
+# report with the first MAX_FAILED_IDS of each, and all of them are written next to the CSV report,
+# e.g. catalog_report.added.txt, one id per line.
+INCREMENTAL = False
+INDEX_DIR = 'item_catalog.index'
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Shape of a DATETIME_FORMAT value that pandas can parse without falling back to strptime.
+DATETIME_PATTERN = r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{1,6}'
+
+# Range checks of updated_at, against the local time of the validating machine.
+# Set MAX_UPDATED_AT_AGE_DAYS to None to accept any age. Rows pass or fail these checks as time goes by,
+# so incremental runs apply the updated_at rule to every row, including unchanged ones, when either is on.
+REJECT_FUTURE_UPDATED_AT = False
+MAX_UPDATED_AT_AGE_DAYS = None
+
+# Declared catalog schema. Low-cardinality columns load as categoricals and text as Arrow-backed strings
+# (plain nullable strings without pyarrow). Columns that are not listed load as strings too.
+# Int64 / Float64 columns are kept as text while loading, since read_csv aborts the whole load on a single
+# malformed number, and their rules check that every value fits the declared type.
+STRING = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else 'string'
+CATALOG_SCHEMA = {
+    'id': STRING,
+    'seller_id': 'category',
+    'seller_name': 'category',
+    'title': STRING,
+    'normal_price': 'Int64',
+    'price_pc': 'Float64',
+    'link': STRING,
+    'image_link': STRING,
+    'category': 'category',
+    'review_count': 'Int64',
+    'rating': 'Float64',
+    'shipping': 'Float64',
+    'brand': 'category',
+    'longtail_yn': 'category',
+    'updated_at': STRING,
+    'availability': 'category',
+    'blocked': 'category'}
+
+REQUIRED_COLUMNS = {
+    'id',
+    'seller_id',
+    'seller_name',
+    'title',
+    'normal_price',
+    'price_pc',
+    'link',
+    'image_link',
+    'category',
+    'review_count',
+    'rating',
+    'shipping',
+    'brand',
+    'longtail_yn',
+    'updated_at',
+    'availability',
+    'blocked'}
+
+#
+#
+# Catalog loading
+#
+#
+def catalog_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if extension in ARROW_EXTENSIONS:
+        return 'arrow'
+    return 'text'
+
+def read_catalog(filename=FILENAME, chunksize=CHUNKSIZE, columns=None):
+    """
+    Yields the catalog as DataFrame chunks of up to chunksize rows, loading only the given columns
+    with the dtypes of CATALOG_SCHEMA. Row numbers keep counting across chunks, so they always refer
+    to the row in the file.
+    """
+    if catalog_format(filename) != 'text':
+        yield from read_catalog_range(filename, 0, count_units(filename), chunksize, columns)
+        return
+    if chunksize is None:
+        yield read_csv(filename, sep='\t', encoding='utf8', usecols=columns, dtype=load_dtypes())
+        return
+    with read_csv(filename, sep='\t', encoding='utf8', usecols=columns, dtype=load_dtypes(),
+                  chunksize=chunksize) as reader:
+        yield from reader
+
+def load_dtypes():
+    dtypes = {column: STRING if dtype in ('Int64', 'Float64') else dtype for column, dtype in CATALOG_SCHEMA.items()}
+    return defaultdict(lambda: STRING, dtypes)
+
+def read_header(filename=FILENAME):
+    file_format = catalog_format(filename)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pd.Index(pq.read_schema(filename, memory_map=True).names)
+    if file_format == 'arrow':
+        import pyarrow as pa
+        return pd.Index(pa.ipc.open_file(pa.memory_map(filename)).schema.names)
+    return read_csv(filename, sep='\t', encoding='utf8', nrows=0).columns
+
+def count_units(filename):
+    """
+    Number of row groups of a Parquet file or record batches of a Feather / Arrow IPC file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if catalog_format(filename) == 'parquet':
+        return pq.ParquetFile(filename, memory_map=True).num_row_groups
+    return pa.ipc.open_file(pa.memory_map(filename)).num_record_batches
+
+def split_catalog(filename, parts):
+    """
+    Splits the data rows of the file into at most parts ranges of about the same size.
+    Columnar files are split by row groups or record batches. Text files are split into byte ranges
+    that start at the beginning of a row, skipping line breaks inside quoted fields.
+    """
+    if catalog_format(filename) != 'text':
+        count = count_units(filename)
+        bounds = sorted({count * part // parts for part in range(parts + 1)})
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        f.readline()
+        header_end = f.tell()
+        if size <= header_end:
+            return [(header_end, size)]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            bounds = [header_end] + row_starts(data, header_end,
+                                               [header_end + (size - header_end) * part // parts for part in range(1, parts)])
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# A quote that opens a field, and the rest of a quoted field up to its closing quote ("" is an escaped quote).
+# Like read_csv, a quote inside an unquoted field is an ordinary character.
+OPENING_QUOTE = re.compile(rb'(?<=[\t\n])"')
+QUOTED_FIELD_END = re.compile(rb'[^"]*(?:""[^"]*)*"')
+
+def row_starts(data, start, targets):
+    """
+    Offsets of the first row starting at or after each target offset, scanning the quoted fields from start.
+    Targets that fall into the last row are dropped.
+    """
+    starts = []
+    targets = iter(targets)
+    target = next(targets, None)
+    quote = OPENING_QUOTE.search(data, start)
+    position = start
+    while target is not None:
+        quote_start = quote.start() if quote else len(data)
+        if target < quote_start:
+            newline = data.find(b'\n', max(target - 1, position), quote_start)
+            if newline >= 0:
+                if newline + 1 < len(data) and (not starts or starts[-1] < newline + 1):
+                    starts.append(newline + 1)
+                target = next(targets, None)
+                continue
+        if quote is None:
+            break
+        end = QUOTED_FIELD_END.match(data, quote_start + 1)
+        if end is None:
+            break # The quoted field is not closed, read_csv reports the error
+        position = end.end()
+        quote = OPENING_QUOTE.search(data, position)
+    return starts
+
+class RangeFile(io.RawIOBase):
+    """
+    Read-only view of the bytes between start and end of a file.
+    """
+    def __init__(self, filename, start, end):
+        self.file = open(filename, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        size = self.file.readinto(memoryview(buffer)[:size])
+        self.remaining -= size
+        return size
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def read_catalog_range(filename, start, end, chunksize=CHUNKSIZE, columns=None):
+    """
+    Yields the rows of one range from split_catalog as DataFrame chunks.
+    Row numbers start at 0 for every range.
+    """
+    if catalog_format(filename) != 'text':
+        yield from read_columnar_range(filename, start, end, chunksize, columns)
+        return
+    names = list(read_header(filename))
+    with io.BufferedReader(RangeFile(filename, start, end)) as f:
+        if chunksize is None:
+            yield read_csv(f, sep='\t', encoding='utf8', header=None, names=names, usecols=columns,
+                           dtype=load_dtypes())
+            return
+        with read_csv(f, sep='\t', encoding='utf8', header=None, names=names, usecols=columns,
+                      dtype=load_dtypes(), chunksize=chunksize) as reader:
+            yield from reader
+
+def read_columnar_range(filename, start, end, chunksize=CHUNKSIZE, columns=None):
+    """
+    Yields the row groups (Parquet) or record batches (Feather / Arrow IPC) from start to end
+    as DataFrame chunks. The file is memory-mapped and only the given columns are read.
+    Columns are cast to the dtypes of CATALOG_SCHEMA, like the TSV columns.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if catalog_format(filename) == 'parquet':
+        f = pq.ParquetFile(filename, memory_map=True)
+        if chunksize is None:
+            batches = f.read_row_groups(range(start, end), columns=columns).to_batches()
+        else:
+            batches = f.iter_batches(batch_size=chunksize, row_groups=range(start, end), columns=columns)
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(filename))
+        batches = (reader.get_batch(i) for i in range(start, end))
+        if columns is not None:
+            batches = (batch.select(columns) for batch in batches)
+        if chunksize is None:
+            batches = pa.Table.from_batches(list(batches), reader.schema if columns is None else None).to_batches()
+
+    dtypes = load_dtypes()
+    offset = 0
+    for batch in batches:
+        chunk = batch.to_pandas()
+        chunk = chunk.astype({column: dtypes[column] for column in chunk.columns})
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk
+
+#
+#
+# Validation engine
+#
+#
+def new_report(rules):
+    return {
+        'rows': 0,
+        'rules': {rule.__name__: {'failed_count': 0, 'failed_rows': [], 'failed_ids': [], 'samples': []}
+                  for rule in rules},
+        'url_cache': {'hits': 0, 'misses': 0},
+        'incremental': {'skipped': 0, **{key: {'count': 0, 'ids': []} for key in ID_CHANGES}},
+        'memory': {}}
+
+def validate_chunk(chunk, rules, report, failures=None):
+    """
+    Applies every rule to the chunk, counts the failing rows in the report and writes them
+    to the failures csv.writer. Only the first MAX_FAILED_IDS rows and ids are kept in the report.
+    """
+    for rule in rules:
+        test_passed = rule(chunk)
+        result = report['rules'][rule.__name__]
+        failed_rows = chunk.index[~test_passed].tolist()
+        if not failed_rows:
+            continue
+        failed_ids = id_strings(chunk.id[~test_passed]).tolist()
+        result['failed_count'] += len(failed_rows)
+        kept = MAX_FAILED_IDS - len(result['failed_rows'])
+        if kept > 0:
+            result['failed_rows'].extend(failed_rows[:kept])
+            result['failed_ids'].extend(failed_ids[:kept])
+        if failures is not None:
+            failures.writerows(zip(itertools.repeat(rule.__name__), failed_rows, failed_ids))
+
+        needed = SAMPLE_SIZE - len(result['samples'])
+        if needed > 0 and failed_rows:
+            for row, values in chunk.loc[failed_rows[:needed]].iterrows():
+                result['samples'].append({'row': row, 'values': {column: json_value(value) for column, value in values.items()}})
+    return report
+
+def validate_catalog(chunks, rules=None, part=None, failures=None):
+    """
+    Validates all the chunks in a single pass and returns the failures aggregated across chunks.
+    Every failing row is written to the failures csv.writer when it is given.
+    With part set, only rows that are new or changed since the last successful run are validated,
+    except by the time_dependent_rules, and every row is recorded in the part files of the next index.
+    """
+    rules = RULES if rules is None else rules
+    report = new_report(rules)
+    index = load_index() if part else None
+    every_row_rules = time_dependent_rules(rules) if part else []
+    changed_row_rules = [rule for rule in rules if rule not in every_row_rules]
+    cache_before = valid_url.cache_info()
+    for chunk in chunks:
+        report['rows'] += len(chunk)
+        record_memory(chunk, report)
+        validate_chunk(chunk, every_row_rules, report, failures)
+        if part:
+            chunk = diff_chunk(chunk, index, part, report)
+        validate_chunk(chunk, changed_row_rules, report, failures)
+    cache_after = valid_url.cache_info()
+    report['url_cache']['hits'] += cache_after.hits - cache_before.hits
+    report['url_cache']['misses'] += cache_after.misses - cache_before.misses
+    return report
+
+def time_dependent_rules(rules):
+    """
+    Rules whose result on an unchanged row depends on the current time with the configured range checks.
+    """
+    if not REJECT_FUTURE_UPDATED_AT and MAX_UPDATED_AT_AGE_DAYS is None:
+        return []
+    return [rule for rule in rules if rule is assert_wellformed_updated_at]
+
+def record_memory(chunk, report):
+    """
+    Keeps the largest in-memory size of each column over all chunks.
+    """
+    for column, size in chunk.memory_usage(index=False, deep=True).items():
+        report['memory'][column] = max(report['memory'].get(column, 0), int(size))
+
+def validate_range(filename, start, end, rules=None, chunksize=CHUNKSIZE, incremental=False, failures_filename=None):
+    """
+    Validates one range from split_catalog. The failing rows are written to failures_filename,
+    numbered from 0 for the range like the rows of the report.
+    """
+    part = index_part(start) if incremental else None
+    columns = needed_columns(rules, incremental)
+    with failures_file(failures_filename) as failures:
+        return validate_catalog(read_catalog_range(filename, start, end, chunksize, columns), rules, part, failures)
+
+@contextlib.contextmanager
+def failures_file(filename, header=False):
+    """
+    csv.writer of the failing rows, or None without a filename.
+    """
+    if not filename:
+        yield None
+        return
+    with open(filename, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(['rule', 'row', 'id'])
+        yield writer
+
+def merge_reports(reports, rules=None):
+    """
+    Merges the reports of consecutive ranges of the file into one report.
+    Row numbers of every range are shifted by the number of rows before it.
+    """
+    rules = RULES if rules is None else rules
+    merged = new_report(rules)
+    for report in reports:
+        offset = merged['rows']
+        merged['rows'] += report['rows']
+        for name, result in report['rules'].items():
+            merged_result = merged['rules'][name]
+            merged_result['failed_count'] += result['failed_count']
+            kept = MAX_FAILED_IDS - len(merged_result['failed_rows'])
+            merged_result['failed_rows'].extend(row + offset for row in result['failed_rows'][:kept])
+            merged_result['failed_ids'].extend(result['failed_ids'][:kept])
+            for sample in result['samples'][:SAMPLE_SIZE - len(merged_result['samples'])]:
+                merged_result['samples'].append(sample | {'row': sample['row'] + offset})
+        for counter, value in report['url_cache'].items():
+            merged['url_cache'][counter] += value
+        merged['incremental']['skipped'] += report['incremental']['skipped']
+        for key in ID_CHANGES:
+            add_ids(merged['incremental'][key], report['incremental'][key]['ids'], report['incremental'][key]['count'])
+        for column, size in report['memory'].items():
+            merged['memory'][column] = max(merged['memory'].get(column, 0), size)
+    return merged
+
+def validate_catalog_parallel(filename=FILENAME, workers=WORKERS, rules=None, chunksize=CHUNKSIZE, incremental=False,
+                              csv_filename=None):
+    """
+    Validates byte ranges of the file in a process pool, one range per worker,
+    and merges the results into a single report. Every worker writes its failing rows to a part file,
+    and the part files are appended to csv_filename in the order of the ranges.
+    """
+    ranges = split_catalog(filename, workers)
+    parts = ['{0}.part-{1:020d}'.format(csv_filename, start) if csv_filename else None for start, _ in ranges]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(validate_range, filename, start, end, rules, chunksize, incremental, part)
+                       for (start, end), part in zip(ranges, parts)]
+            reports = [future.result() for future in futures]
+        with failures_file(csv_filename, header=True) as failures:
+            offset = 0
+            for report, part in zip(reports, parts):
+                if failures is not None:
+                    with open(part, encoding='utf8', newline='') as f:
+                        failures.writerows([name, int(row) + offset, id] for name, row, id in csv.reader(f))
+                offset += report['rows']
+    finally:
+        for part in parts:
+            if part and os.path.exists(part):
+                os.remove(part)
+    return merge_reports(reports, rules)
+
+def needed_columns(rules=None, incremental=False):
+    """
+    Columns to load for the rules, plus id for the report. Incremental runs hash whole rows,
+    so they load every column.
+    """
+    if incremental:
+        return None
+    rules = RULES if rules is None else rules
+    return list(dict.fromkeys(['id'] + [column for rule in rules for column in RULE_COLUMNS[rule]]))
+
+def validate_file(filename=FILENAME, workers=WORKERS, rules=None, chunksize=CHUNKSIZE, incremental=INCREMENTAL,
+                  csv_filename=REPORT_CSV):
+    """
+    Validates the catalog and writes every failing row to the CSV report csv_filename.
+    """
+    if incremental:
+        start_index()
+    if workers > 1:
+        report = validate_catalog_parallel(filename, workers, rules, chunksize, incremental, csv_filename)
+    else:
+        part = index_part(0) if incremental else None
+        columns = needed_columns(rules, incremental)
+        with failures_file(csv_filename, header=True) as failures:
+            report = validate_catalog(read_catalog(filename, chunksize, columns), rules, part, failures)
+    if incremental:
+        finish_index(report, csv_filename=csv_filename)
+    return report
+
+def print_report(report):
+    print('Validated', report['rows'] - report['incremental']['skipped'], 'of', report['rows'], 'rows')
+    for name, result in report['rules'].items():
+        print('{0:<36} {1:>10} failed  {2}'.format(name, result['failed_count'], ' '.join(result['failed_ids'][:SAMPLE_SIZE])))
+    print('URL cache hits', report['url_cache']['hits'], 'misses', report['url_cache']['misses'])
+    print('Memory per chunk', sum(report['memory'].values()) // 2**20, 'MiB')
+    for column, size in report['memory'].items():
+        print('  {0:<34} {1:>10.1f} MiB  {2}'.format(column, size / 2**20, load_dtypes()[column]))
+    if report['incremental']['skipped']:
+        print('Unchanged rows skipped', report['incremental']['skipped'])
+    for key in ID_CHANGES:
+        if report['incremental'][key]['count']:
+            print(key.capitalize(), 'ids', report['incremental'][key]['count'])
+
+# The CSV report of every failing row is written by validate_file while it validates.
+def write_report(report, json_filename=REPORT_JSON):
+    if json_filename:
+        with open(json_filename, 'w', encoding='utf8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+
+#
+#
+# Incremental validation
+#
+# The index of the last successful run is a directory of sorted id hashes, the row hash of each id
+# and the line of each id in ids.txt. The hash arrays are memory-mapped, so worker processes share them.
+# Each run writes the ids and hashes of its rows to part files in INDEX_DIR + '.new', which become
+# the index once the run finishes without failures.
+#
+#
+ID_CHANGES = ('added', 'changed', 'removed')
+
+def add_ids(result, ids, count=None):
+    """
+    Counts the ids in an added, changed or removed result of the report and keeps the first MAX_FAILED_IDS of them.
+    """
+    result['count'] += len(ids) if count is None else count
+    result['ids'].extend(ids[:max(MAX_FAILED_IDS - len(result['ids']), 0)])
+
+def ids_filename(csv_filename, key):
+    """
+    File of all the added, changed or removed ids next to the CSV report, or None without a CSV report.
+    """
+    return '{0}.{1}.txt'.format(os.path.splitext(csv_filename)[0], key) if csv_filename else None
+
+def load_index(index_dir=INDEX_DIR):
+    names = ('id_hashes', 'row_hashes', 'lines')
+    if not os.path.isdir(index_dir):
+        return {name: np.array([], dtype=np.uint64) for name in names}
+    return {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r') for name in names}
+
+def index_part(start, index_dir=INDEX_DIR):
+    return os.path.join(index_dir + '.new', 'part-%020d' % start)
+
+def hash_rows(chunk):
+    ids = id_strings(chunk.id)
+    id_hashes = pd.util.hash_array(ids.to_numpy(dtype=object))
+    row_hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+    return ids, id_hashes, row_hashes
+
+def diff_chunk(chunk, index, part, report):
+    """
+    Returns the rows of the chunk that are new or changed compared to the index
+    and records the ids and hashes of all its rows in the part files.
+    """
+    ids, id_hashes, row_hashes = hash_rows(chunk)
+    with open(part + '.ids', 'a', encoding='utf8') as f:
+        f.writelines(id + '\n' for id in ids)
+    with open(part + '.hashes', 'ab') as f:
+        np.column_stack([id_hashes, row_hashes]).tofile(f)
+
+    known = np.zeros(len(chunk), dtype=bool)
+    changed = np.zeros(len(chunk), dtype=bool)
+    if len(index['id_hashes']):
+        positions = np.minimum(np.searchsorted(index['id_hashes'], id_hashes), len(index['id_hashes']) - 1)
+        known = index['id_hashes'][positions] == id_hashes
+        changed = known & (index['row_hashes'][positions] != row_hashes)
+
+    report['incremental']['skipped'] += int((known & ~changed).sum())
+    for key, mask in (('added', ~known), ('changed', changed)):
+        new_ids = ids[mask].tolist()
+        add_ids(report['incremental'][key], new_ids)
+        with open(part + '.' + key, 'a', encoding='utf8') as f:
+            f.writelines(id + '\n' for id in new_ids)
+    return chunk[~known | changed]
+
+def start_index(index_dir=INDEX_DIR):
+    shutil.rmtree(index_dir + '.new', ignore_errors=True)
+    os.makedirs(index_dir + '.new')
+
+def finish_index(report, index_dir=INDEX_DIR, csv_filename=REPORT_CSV):
+    """
+    Builds the new index from the part files and adds the ids removed since the last run to the report.
+    The added, changed and removed ids are written to their ids_filename next to the CSV report.
+    The new index replaces the old one only if no rule failed.
+    """
+    staging = index_dir + '.new'
+    parts = sorted(name[:-len('.ids')] for name in os.listdir(staging) if name.endswith('.ids'))
+    hashes = [np.fromfile(os.path.join(staging, part + '.hashes'), dtype=np.uint64).reshape(-1, 2) for part in parts]
+    hashes = np.concatenate(hashes) if hashes else np.empty((0, 2), dtype=np.uint64)
+    lines = np.argsort(hashes[:, 0], kind='stable')
+    np.save(os.path.join(staging, 'id_hashes.npy'), hashes[lines, 0])
+    np.save(os.path.join(staging, 'row_hashes.npy'), hashes[lines, 1])
+    np.save(os.path.join(staging, 'lines.npy'), lines.astype(np.uint64))
+    with open(os.path.join(staging, 'ids.txt'), 'w', encoding='utf8') as ids:
+        for part in parts:
+            with open(os.path.join(staging, part + '.ids'), encoding='utf8') as f:
+                shutil.copyfileobj(f, ids)
+            os.remove(os.path.join(staging, part + '.ids'))
+            os.remove(os.path.join(staging, part + '.hashes'))
+    for key in ('added', 'changed'):
+        with open(ids_filename(csv_filename, key) or os.devnull, 'w', encoding='utf8') as ids:
+            for part in parts:
+                with open(os.path.join(staging, part + '.' + key), encoding='utf8') as f:
+                    shutil.copyfileobj(f, ids)
+                os.remove(os.path.join(staging, part + '.' + key))
+
+    index = load_index(index_dir)
+    removed = np.zeros(len(index['lines']), dtype=bool)
+    removed[index['lines'][~np.isin(index['id_hashes'], hashes[:, 0])].astype(np.int64)] = True
+    with open(ids_filename(csv_filename, 'removed') or os.devnull, 'w', encoding='utf8') as ids:
+        if removed.any():
+            with open(os.path.join(index_dir, 'ids.txt'), encoding='utf8') as f:
+                for line, id in enumerate(f):
+                    if removed[line]:
+                        ids.write(id)
+                        add_ids(report['incremental']['removed'], [id.rstrip('\n')])
+    del index
+
+    if any(result['failed_count'] for result in report['rules'].values()):
+        shutil.rmtree(staging)
+    else:
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(staging, index_dir)
+
+#
+#
+# Helper functions
+#
+#
+def parse_datetime(date_text):
+    try:
+        return datetime.datetime.strptime(date_text, DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        return pd.NaT
+
+def id_strings(col):
+    return col.where(col.notna(), '').astype(str)
+
+def json_value(value):
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def str_len(col):
+    """
+    Length of every string value in the column.
+    Values that are not strings get NaN, so any length comparison on them fails.
+    """
+    try:
+        return col.str.len().astype('float64')
+    except AttributeError:
+        return pd.Series(np.nan, index=col.index)
+
+def str_test(col, method, *args, **kwargs):
+    """
+    Runs a boolean Series.str method such as startswith or contains.
+    Values that are missing or not strings fail the test.
+    """
+    try:
+        result = getattr(col.str, method)(*args, **kwargs)
+    except AttributeError:
+        return pd.Series(False, index=col.index)
+    return result.eq(True).fillna(False).astype(bool)
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def valid_url(url):
+    return bool(validators.url(url))
+
+def valid_links(col):
+    """
+    Rejects empty, oversized and non-https values with cheap column-wide checks first.
+    Only the remaining values go through the validators.url regex, once per distinct value with UNIQUE_URLS.
+    """
+    test_passed = col.notna() \
+        & (str_len(col) <= MAX_URL_LENGTH) \
+        & str_test(col, 'startswith', 'https')
+    if UNIQUE_URLS:
+        codes, uniques = pd.factorize(col[test_passed])
+        test_passed[test_passed] = np.array([valid_url(url) for url in uniques], dtype=bool)[codes]
+    else:
+        test_passed[test_passed] = col[test_passed].map(valid_url).astype(bool)
+    return test_passed
+
+def fits_dtype(col, dtype):
+    """
+    True where the value is empty or fits the declared Int64 / Float64 dtype.
+    Text values are parsed with to_numeric, so a missing value never turns the rest of the column into floats.
+    """
+    if pd.api.types.is_bool_dtype(col.dtype):
+        return col.isna()
+    numbers = pd.to_numeric(col, errors='coerce').astype('float64')
+    test_passed = numbers.notna()
+    if dtype == 'Int64':
+        test_passed &= (numbers % 1 == 0) & (numbers.abs() < 2**63)
+    return col.isna() | test_passed
+
+def parse_datetimes(values):
+    """
+    Parses DATETIME_FORMAT values into datetimes, NaT where a value is missing or malformed.
+    Values with the usual shape are parsed by pandas at once, anything else that is a string
+    goes through strptime, so the result is the same as parse_datetime for every value.
+    """
+    values = pd.Series(values)
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[us]')
+    candidates = str_test(values, 'fullmatch', DATETIME_PATTERN)
+    parsed[candidates] = to_datetime(values[candidates], format=DATETIME_FORMAT, errors='coerce')
+    rest = parsed.isna()
+    parsed[rest] = values[rest].map(parse_datetime)
+    return parsed
+
+def valid_datetimes(col):
+    """
+    Checks the format and the REJECT_FUTURE_UPDATED_AT / MAX_UPDATED_AT_AGE_DAYS range of every value.
+    Catalog exports share batch timestamps, so each distinct value is parsed and checked once
+    and the results are broadcast back to the rows.
+    """
+    codes, uniques = pd.factorize(col)
+    parsed = parse_datetimes(uniques)
+    test_passed = parsed.notna()
+
+    now = datetime.datetime.now()
+    if REJECT_FUTURE_UPDATED_AT:
+        test_passed &= parsed <= now
+    if MAX_UPDATED_AT_AGE_DAYS is not None:
+        test_passed &= parsed >= now - datetime.timedelta(days=MAX_UPDATED_AT_AGE_DAYS)
+
+    # Missing values have the code -1 and pick the trailing False.
+    test_passed = np.append(test_passed.to_numpy(dtype=bool), False)[codes]
+    return pd.Series(test_passed, index=col.index)
+
+#
+#
+# Column value validation rules
+#
+# Each rule takes a DataFrame (the whole catalog or one chunk of it) and
+# returns a boolean Series, True for the rows that are well-formed.
+#
+#
+def assert_wellformed_id(df):
+    """
+    id length can be up to 50 characters.
+    """
+    col = df.id
+    return col.isna() | (str_len(col.astype(str)) <= 50)
+
+def assert_wellformed_seller_id(df):
+    """
+    seller_id length can be up to 50 characters.
+    """
+    col = df.seller_id
+    return col.isna() | (str_len(col.astype(str)) <= 50)
+
+def assert_wellformed_seller_name(df):
+    """
+    If blocked is None or 'in_stock,' seller_name must have valune with length of up to 200 characters.
+    If blocked is 'unavailable,' seller_name must be 'undefined'
+    """
+    blocked = df.blocked
+    seller_name = df.seller_name
+
+    listed = blocked.isna() | blocked.eq('in_stock')
+    unavailable = blocked.eq('unavailable')
+    return (~listed | (str_len(seller_name) <= 200)) \
+        & (~unavailable | seller_name.eq('undefined'))
+
+def assert_wellformed_title(df):
+    """
+    title length can be up to 200 characters.
+    """
+    col = df.title
+    return col.isna() | (str_len(col.astype(str)) <= 200)
+
+def assert_wellformed_normal_price(df):
+    """
+    normal_price column must be integer
+    """
+    return fits_dtype(df.normal_price, CATALOG_SCHEMA['normal_price'])
+
+def assert_wellformed_price_pc(df):
+    """
+    price_pc column must be float
+    """
+    return fits_dtype(df.price_pc, CATALOG_SCHEMA['price_pc'])
+
+def assert_wellformed_link(df):
+    """
+    link length can be up to 2000 characters.
+    It should start with 'https'
+    It should follow RFC 2396 or RFC 1738
+    """
+    return valid_links(df.link)
+
+def assert_wellformed_image_link(df):
+    """
+    image_link length can be up to 2000 characters.
+    It should start with 'https'
+    It should follow RFC 2396 or RFC 1738
+    """
+    return valid_links(df.image_link)
+
+def assert_wellformed_category(df):
+    """
+    category can be up to 750 characters.
+    It should use '>' character to indicate the category levels.
+    """
+    col = df.category
+    return col.notna() & (str_len(col) <= 750) & str_test(col, 'contains', '>', regex=False)
+
+def assert_wellformed_review_count(df):
+    """
+    review_count column must be integer
+    """
+    return fits_dtype(df.review_count, CATALOG_SCHEMA['review_count'])
+
+def assert_wellformed_rating(df):
+    """
+    rating column must be float
+    """
+    return fits_dtype(df.rating, CATALOG_SCHEMA['rating'])
+
+def assert_wellformed_shipping(df):
+    """
+    shipping column must be float
+    """
+    return fits_dtype(df.shipping, CATALOG_SCHEMA['shipping'])
+
+def assert_wellformed_brand(df):
+    """
+    brand can be up to 70 characters.
+    """
+    col = df.brand
+    return col.notna() & (str_len(col) <= 70)
+
+def assert_wellformed_longtail_yn(df):
+    """
+    longtail_yn must be 'Y' or 'N'
+    """
+    return df.longtail_yn.isin(['Y', 'N'])
+
+def assert_wellformed_updated_at(df):
+    """
+    updated_at must be '%Y-%m-%d %H:%M:%S.%f'
+    It must not be in the future with REJECT_FUTURE_UPDATED_AT
+    and not older than MAX_UPDATED_AT_AGE_DAYS days when it is set.
+    """
+    col = df.updated_at
+    return col.notna() & valid_datetimes(col)
+
+def assert_wellformed_availability(df):
+    """
+    availability must be empty, 'in_stock' or 'out_of_stock'
+    """
+    col = df.availability
+    return col.isna() | col.isin(['in_stock', 'out_of_stock'])
+
+def assert_wellformed_blocked(df):
+    """
+    Blocked column must be empty, 'in_stock', or 'unavailable'
+    """
+    col = df.blocked
+    return col.isna() | col.isin(['in_stock', 'unavailable'])
+
+
+RULES = [
+    assert_wellformed_id,
+    assert_wellformed_seller_id,
+    assert_wellformed_seller_name,
+    assert_wellformed_title,
+    assert_wellformed_normal_price,
+    assert_wellformed_price_pc,
+    assert_wellformed_link,
+    assert_wellformed_image_link,
+    assert_wellformed_category,
+    assert_wellformed_review_count,
+    assert_wellformed_rating,
+    assert_wellformed_shipping,
+    assert_wellformed_brand,
+    assert_wellformed_longtail_yn,
+    assert_wellformed_updated_at,
+    assert_wellformed_availability,
+    assert_wellformed_blocked]
+
+# Columns each rule reads. Only these columns are loaded from the catalog.
+RULE_COLUMNS = {
+    assert_wellformed_id: ['id'],
+    assert_wellformed_seller_id: ['seller_id'],
+    assert_wellformed_seller_name: ['seller_name', 'blocked'],
+    assert_wellformed_title: ['title'],
+    assert_wellformed_normal_price: ['normal_price'],
+    assert_wellformed_price_pc: ['price_pc'],
+    assert_wellformed_link: ['link'],
+    assert_wellformed_image_link: ['image_link'],
+    assert_wellformed_category: ['category'],
+    assert_wellformed_review_count: ['review_count'],
+    assert_wellformed_rating: ['rating'],
+    assert_wellformed_shipping: ['shipping'],
+    assert_wellformed_brand: ['brand'],
+    assert_wellformed_longtail_yn: ['longtail_yn'],
+    assert_wellformed_updated_at: ['updated_at'],
+    assert_wellformed_availability: ['availability'],
+    assert_wellformed_blocked: ['blocked']}
+
+
+def main():
+    report = validate_file(FILENAME, WORKERS)
+    write_report(report)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
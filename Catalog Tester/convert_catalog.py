@@ -0,0 +1,54 @@
+# Copyright 2023 Moloco, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from catalog_validator import read_catalog, CHUNKSIZE, STRING
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Converts the TSV catalog to Parquet once, so that repeated validations skip text parsing.
+# Validate the result by setting FILENAME = PARQUET_FILENAME in catalog_validator.py.
+FILENAME = 'item_catalog.tsv'
+PARQUET_FILENAME = 'item_catalog.parquet'
+
+# Rows per Parquet row group. Row groups are the unit of parallel validation.
+ROW_GROUP_SIZE = CHUNKSIZE
+
+
+def convert_to_parquet(filename, parquet_filename, chunksize=ROW_GROUP_SIZE):
+    """
+    Every chunk is read with the dtypes of CATALOG_SCHEMA, so all row groups share one schema.
+    Categoricals are written as strings, their categories differ between chunks and Parquet
+    dictionary-encodes repeated strings anyway.
+    """
+    writer = None
+    rows = 0
+    for chunk in read_catalog(filename, chunksize):
+        chunk = chunk.astype({column: STRING for column in chunk.select_dtypes('category').columns})
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(parquet_filename, table.schema)
+        writer.write_table(table, row_group_size=chunksize)
+        rows += len(chunk)
+    if writer is not None:
+        writer.close()
+    return rows
+
+
+def main():
+    rows = convert_to_parquet(FILENAME, PARQUET_FILENAME)
+    print("Total {0} rows are written to {1}.".format(rows, PARQUET_FILENAME))
+
+
+if __name__ == '__main__':
+    main()